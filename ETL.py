@@ -1,13 +1,33 @@
-from turtle import color
-import matplotlib.pyplot as plt
 import math
 import copy
+import bisect
 
 import numpy as np
-import pandas as pd
 
+import instrument
 from partition import *
 
+# matplotlib and pandas are not needed for the geometry and hit testing, they are only imported when they are used
+# (plt and pd are still provided by from ETL import *, see __getattr__)
+__all__ = [
+    'np', 'math', 'copy', 'bisect', 'plt', 'pd',
+    'partition', 'getPartition', 'solve',
+    'colors', 'MAX_CHUNK_ELEMENTS',
+    'three_vector', 'TrackBatch', 'pixelGrid', 'coveredRectangles', 'diskArea', 'radialArea',
+    'Pixel', 'Placement', 'SensorBase', 'Sensor2', 'Sensor', 'ReadoutBoard', 'PowerBoard', 'Module', 'SuperModule',
+    'RectangleIndex', 'Dee', 'Propagation', 'layerPositions', 'propagate',
+]
+
+
+def __getattr__(name):
+    if name == 'plt':
+        import matplotlib.pyplot as plt
+        return plt
+    if name == 'pd':
+        import pandas as pd
+        return pd
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 colors = {
     3: 'cyan',
@@ -18,6 +38,9 @@ colors = {
     14: 'green'
 }
 
+# number of points looked up at once by Dee.intersect_many
+MAX_CHUNK_ELEMENTS = 2**20
+
 
 class three_vector:
     def __init__(self, x, y, z):
@@ -41,8 +64,178 @@ class three_vector:
 
         return cls
 
+
+class TrackBatch(object):
+    columns = ('x', 'y', 'z', 'r', 'theta', 'eta', 'phi')
+
+    def __init__(self, data):
+        '''
+        Columnar replacement for a list of three_vector: data is a (7, N) array with the rows x, y, z, r, theta, eta, phi,
+        which are also accessible as attributes (views, nothing is copied).
+        Use fromEtaPhi or fromXYZ to create one.
+        '''
+        self.data = data
+        for i, column in enumerate(self.columns):
+            setattr(self, column, data[i])
+
+    @classmethod
+    def fromEtaPhi(cls, eta, phi, z, dtype=float):
+        '''
+        dtype=np.float32 halves the memory, but the positions are then only good to ~0.1 mm
+        '''
+        eta = np.asarray(eta, dtype=float)
+        data = np.empty((len(cls.columns), len(eta)), dtype=dtype)
+        x, y, z_, r, theta, eta_, phi_ = data
+        eta_[:] = eta
+        phi_[:] = phi
+        z_[:] = z
+        theta[:] = 2*np.arctan(np.exp(eta*(-1)))
+        r[:] = z_*np.tan(theta)
+        x[:] = r*np.cos(phi_)
+        y[:] = r*np.sin(phi_)
+        return cls(data)
+
+    @classmethod
+    def fromXYZ(cls, x, y, z, dtype=float):
+        x = np.asarray(x, dtype=float)
+        data = np.empty((len(cls.columns), len(x)), dtype=dtype)
+        x_, y_, z_, r, theta, eta, phi = data
+        x_[:] = x
+        y_[:] = y
+        z_[:] = z
+        r[:] = np.sqrt(x_**2+y_**2)
+        theta[:] = np.arctan2(r, z_)
+        eta[:] = -np.log(np.tan(theta/2))
+        phi[:] = np.arctan2(y_, x_)
+        return cls(data)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, key):
+        '''
+        slices give views of the same memory, boolean masks and index arrays give copies.
+        '''
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key+1 if key != -1 else None)
+        return TrackBatch(self.data[:, key])
+
+    def __iter__(self):
+        '''
+        iterates over three_vector objects, for code that still works with single tracks.
+        '''
+        for x, y, z in zip(self.x, self.y, self.z):
+            yield three_vector(x, y, z)
+
+
+def pixelGrid(u, v, size_u, size_v, m, n, gap):
+    '''
+    locates points in a grid of m x n pixels separated by gap, given the distances (u, v) from the corner of the active area
+    where the pixel grid starts. returns the pixel column, row and whether the point is on a pixel (and not in a gap).
+    '''
+    pitch_u = (abs(size_u)-(m-1)*gap)/m + gap
+    pitch_v = (abs(size_v)-(n-1)*gap)/n + gap
+    iu = np.clip(np.floor(u/pitch_u), 0, m-1).astype(np.int64)
+    iv = np.clip(np.floor(v/pitch_v), 0, n-1).astype(np.int64)
+    du = u - iu*pitch_u
+    dv = v - iv*pitch_v
+    on_pixel = (du > 0) & (du < pitch_u - gap) & (dv > 0) & (dv < pitch_v - gap)
+    return iu, iv, on_pixel
+
+def coveredRectangles(x1, x2, y1, y2, min_count=1):
+    '''
+    disjoint rectangles that cover exactly the points inside at least min_count of the rectangles x1 < x < x2, y1 < y < y2.
+    the plane is cut into slabs between the x edges, in every slab the y intervals are counted.
+    returns the corner arrays x1, x2, y1, y2 of the pieces
+    '''
+    x1, x2, y1, y2 = [np.asarray(v, dtype=float).ravel() for v in (x1, x2, y1, y2)]
+    pieces = [[], [], [], []]
+    if len(x1) == 0:
+        return [np.zeros(0) for _ in pieces]
+
+    order = np.argsort(x1, kind='stable')
+    x1, x2, y1, y2 = x1[order], x2[order], y1[order], y2[order]
+    max_width = (x2-x1).max()
+    edges = np.unique(np.concatenate([x1, x2]))
+
+    for xa, xb in zip(edges[:-1].tolist(), edges[1:].tolist()):
+        # only rectangles starting less than max_width before the slab can reach into it
+        first = np.searchsorted(x1, xa - max_width, side='right')
+        last = np.searchsorted(x1, xb, side='left')
+        active = first + np.nonzero(x2[first:last] > xa)[0]
+        if len(active) < min_count:
+            continue
+        ys = np.concatenate([y1[active], y2[active]])
+        steps = np.concatenate([np.ones(len(active), dtype=np.int64), -np.ones(len(active), dtype=np.int64)])
+        ys_order = np.argsort(ys, kind='stable')
+        ys = ys[ys_order]
+        count = np.cumsum(steps[ys_order])
+        covered = (count[:-1] >= min_count) & (ys[1:] > ys[:-1])
+        n = covered.sum()
+        pieces[0].append(np.full(n, xa))
+        pieces[1].append(np.full(n, xb))
+        pieces[2].append(ys[:-1][covered])
+        pieces[3].append(ys[1:][covered])
+
+    return [np.concatenate(p) if p else np.zeros(0) for p in pieces]
+
+
+def _quadrantArea(x, y, radius):
+    '''
+    signed area of the rectangle between the origin and (x, y) inside the disk of radius around the origin
+    '''
+    a = np.minimum(np.abs(x), radius)
+    b = np.abs(y)
+    # up to u0 the rectangle is below the circle
+    u0 = np.sqrt(np.maximum(radius**2 - b**2, 0))
+    u1 = np.minimum(a, u0)
+
+    def circle(u):
+        return (u*np.sqrt(np.maximum(radius**2 - u**2, 0)) + radius**2*np.arcsin(np.minimum(u/radius, 1)))/2
+
+    return np.sign(x)*np.sign(y)*(np.minimum(b, radius)*u1 + circle(a) - circle(u1))
+
+
+def diskArea(x1, x2, y1, y2, radius):
+    '''
+    area of the rectangles inside the disk of radius around the origin (the arguments are broadcast)
+    '''
+    return _quadrantArea(x2, y2, radius) - _quadrantArea(x1, y2, radius) - _quadrantArea(x2, y1, radius) + _quadrantArea(x1, y1, radius)
+
+
+def radialArea(x1, x2, y1, y2, radii):
+    '''
+    total area of disjoint rectangles inside each of the (increasing) radii around the origin.
+    the exact disk area is only computed for the radii that cut a rectangle.
+    '''
+    x1, x2, y1, y2 = [np.asarray(v, dtype=float).ravel() for v in (x1, x2, y1, y2)]
+    radii = np.asarray(radii, dtype=float)
+
+    # closest and farthest distance of the rectangles to the origin
+    dx_min = np.where(x1 > 0, x1, np.where(x2 < 0, -x2, 0))
+    dy_min = np.where(y1 > 0, y1, np.where(y2 < 0, -y2, 0))
+    r_min = np.sqrt(dx_min**2 + dy_min**2)
+    r_max = np.sqrt(np.maximum(x1**2, x2**2) + np.maximum(y1**2, y2**2))
+    lo = np.searchsorted(radii, r_min, side='left')
+    hi = np.searchsorted(radii, r_max, side='left')
+
+    # rectangles completely inside radii[j] for j >= hi
+    area = (x2-x1)*(y2-y1)
+    inside = np.cumsum(np.bincount(hi, weights=area, minlength=len(radii)+1))[:len(radii)]
+
+    # radii between lo and hi cut the rectangle
+    n_cut = hi - lo
+    rect = np.repeat(np.arange(len(x1)), n_cut)
+    j = np.repeat(lo, n_cut) + np.arange(n_cut.sum()) - np.repeat(np.cumsum(n_cut) - n_cut, n_cut)
+    cut = diskArea(x1[rect], x2[rect], y1[rect], y2[rect], radii[j])
+
+    return inside + np.bincount(j, weights=cut, minlength=len(radii))
+
+
 # defining a new class pixel to account for the pixels in the sensors
 class Pixel:
+    __slots__ = ('x', 'y', 'height', 'width', 'x1', 'x2', 'y1', 'y2', 'outline')
+
     def __init__(self, x, y, height, width):
         self.x = x
         self.y = y
@@ -62,55 +255,196 @@ class Pixel:
         ]
 
     def getPolygon(self):
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline, color='blue', closed=True, edgecolor='black', alpha=0.6)
 
+
+class Placement(object):
+    __slots__ = ('_x', '_y', 'parent', '_corners', '_outline')
+
+    def __init__(self, x=0, y=0):
+        '''
+        Base class of everything that is placed on a Dee (sensors, boards, modules, supermodules).
+        The position of the center is stored relative to the parent (the module of a sensor, the supermodule of a module),
+        so moving something is O(1) and its children follow. x and y are the position in the Dee.
+        The corners (x1, x2, y1, y2) and the outline are computed when they are read and kept until something is moved.
+        '''
+        self._x = x
+        self._y = y
+        self.parent = None
+        self._corners = None
+        self._outline = None
+
+    def getPosition(self):
+        x, y = self._x, self._y
+        parent = self.parent
+        while parent is not None:
+            x += parent._x
+            y += parent._y
+            parent = parent.parent
+        return x, y
+
+    @property
+    def x(self):
+        return self.getPosition()[0]
+
+    @x.setter
+    def x(self, value):
+        self._x = value if self.parent is None else value - self.parent.x
+
+    @property
+    def y(self):
+        return self.getPosition()[1]
+
+    @y.setter
+    def y(self, value):
+        self._y = value if self.parent is None else value - self.parent.y
+
+    def attach(self, child, x=None, y=None):
+        '''
+        makes child move with this object. the child keeps its current position, or is placed at (x, y) relative to the
+        center of this object
+        '''
+        if x is None:
+            x, y = child.getPosition()
+            child.parent = self
+            child.move_to(x, y)
+        else:
+            child.parent = self
+            child._x = x
+            child._y = y
+
+    def getCorners(self):
+        '''
+        x1, x2, y1, y2 with
+        x1 < x2,
+        y1 < y2
+        so (x1, y1) is the lower left corner.
+        '''
+        x, y = self.getPosition()
+        cache = self._corners
+        if cache is None or cache[0] != x or cache[1] != y or cache[2] != self.height or cache[3] != self.width:
+            cache = self._corners = (x, y, self.height, self.width,
+                                     (x - self.height/2., x + self.height/2., y - self.width/2., y + self.width/2.))
+        return cache[4]
+
+    @property
+    def x1(self):
+        return self.getCorners()[0]
+
+    @property
+    def x2(self):
+        return self.getCorners()[1]
+
+    @property
+    def y1(self):
+        return self.getCorners()[2]
+
+    @property
+    def y2(self):
+        return self.getCorners()[3]
+
+    @property
+    def outline(self):
+        corners = self.getCorners()
+        if self._outline is None or self._outline[0] is not corners:
+            x1, x2, y1, y2 = corners
+            self._outline = (corners, [[x1, y2], [x2, y2], [x2, y1], [x1, y1]])
+        return self._outline[1]
+
+    def setOutline(self):
+        '''
+        the corners and the outline are updated when they are read, this only drops the cached ones
+        '''
+        self._corners = None
+        self._outline = None
+
+    def move_to(self, x, y):
+        self.x = x
+        self.y = y
+
+    def move_by(self, x, y):
+        self._x = self._x + x
+        self._y = self._y + y
+
+
+class SensorBase(Placement):
+    __slots__ = ('_active', '_activeArea')
+
+    def __init__(self, x=0, y=0):
+        '''
+        active area of the sensors, computed with getActiveAreaAt when it is read
+        '''
+        Placement.__init__(self, x, y)
+        self._active = None
+        self._activeArea = None
+
+    def getActiveCorners(self):
+        '''
+        ax1, ax2, ay1, ay2 of the active area at the current position
+        '''
+        x, y = self.getPosition()
+        cache = self._active
+        if cache is None or cache[0] != x or cache[1] != y or cache[2] != self.height or cache[3] != self.width:
+            cache = self._active = (x, y, self.height, self.width, self.getActiveAreaAt(x, y))
+        return cache[4]
+
+    @property
+    def ax1(self):
+        return self.getActiveCorners()[0]
+
+    @property
+    def ax2(self):
+        return self.getActiveCorners()[1]
+
+    @property
+    def ay1(self):
+        return self.getActiveCorners()[2]
+
+    @property
+    def ay2(self):
+        return self.getActiveCorners()[3]
+
+    @property
+    def activeArea(self):
+        corners = self.getActiveCorners()
+        if self._activeArea is None or self._activeArea[0] is not corners:
+            ax1, ax2, ay1, ay2 = corners
+            self._activeArea = (corners, [[ax1, ay2], [ax2, ay2], [ax2, ay1], [ax1, ay1]])
+        return self._activeArea[1]
+
+    def setActiveArea(self):
+        '''
+        the active area is updated when it is read, this only drops the cached one (e.g. after changing the deadspace)
+        '''
+        self._active = None
+        self._activeArea = None
+
+
 # defining new sensor which will have the coordinates of the pixles defined in it
-class Sensor2(object):
+class Sensor2(SensorBase):
+    __slots__ = ('height', 'width', 'color', 'deadspace1', 'deadspace2', 'n_pixels', 'x_pixel_size', 'y_pixel_size',
+                 'x0', 'y0', 'centers_new_system', 'centers_pixels', 'pixels')
+
     def __init__(self, height, width, x=0, y=0, deadspace1=0.3, deadspace2=0.5, color='orange'):
         '''
         Create a sensor object with height (in x) and width (in y). x and y define the position of the center
         '''
+        SensorBase.__init__(self, x, y)
         self.height = height
         self.width = width
-        self.x = x
-        self.y = y
         self.color = color
         self.deadspace1 = deadspace1
         self.deadspace2 = deadspace2
 
-        self.setOutline()
-
-    def setOutline(self):
+    def getActiveAreaAt(self, x, y):
         '''
-        set the outline for the polygon, but also the coordinates of the corners in an easily accessible way.
-        x1 < x2,
-        y1 < y2
-        so (x1, y1) is the lower left corner.
+        corners (ax1, ax2, ay1, ay2) of the active area if the sensor was centered at x, y (floats or arrays)
         '''
-        self.x1 = self.x - self.height/2.
-        self.x2 = self.x + self.height/2.
-        self.y1 = self.y - self.width/2.
-        self.y2 = self.y + self.width/2.
-
-        self.outline = [
-            [self.x1, self.y2],
-            [self.x2, self.y2],
-            [self.x2, self.y1],
-            [self.x1, self.y1]
-        ]
-
-    def setActiveArea(self):
-        self.ax1 = self.x - self.height/2. + self.deadspace1
-        self.ax2 = self.x + self.height/2. - self.deadspace1
-        self.ay1 = self.y - self.width/2. + self.deadspace2
-        self.ay2 = self.y + self.width/2. - self.deadspace1
-
-        self.activeArea = [
-            [self.ax1, self.ay2],
-            [self.ax2, self.ay2],
-            [self.ax2, self.ay1],
-            [self.ax1, self.ay1]
-        ]
+        return (x - self.height/2. + self.deadspace1,
+                x + self.height/2. - self.deadspace1,
+                y - self.width/2. + self.deadspace2,
+                y + self.width/2. - self.deadspace1)
 
     def get_pixel_centers(self, m, n, gap):
 
@@ -143,73 +477,62 @@ class Sensor2(object):
             pixel.setOutline()
             self.pixels.append(pixel)
 
-    def getActiveArea(self):
-        return abs((self.ax2-self.ax1)*(self.ay2-self.ay1))
+    @staticmethod
+    def pixelIndex(x, y, ax1, ax2, ay1, ay2, m, n, gap):
+        '''
+        analytic version of get_pixel_centers/getPixelsOutline for arrays of points and active areas.
+        pixels start at (ax1, ay2) and are numbered row by row, like centers_pixels.
+        returns the pixel number, -1 for points in the gaps between pixels.
+        '''
+        ix, iy, on_pixel = pixelGrid(x-ax1, ay2-y, ax2-ax1, ay2-ay1, m, n, gap)
+        return np.where(on_pixel, iy*m + ix, -1)
 
-    def move_to(self, x, y):
-        self.x = x
-        self.y = y
-        self.setOutline()
-        self.setActiveArea()
+    @staticmethod
+    def pixelRectangles(ax1, ax2, ay1, ay2, m, n, gap):
+        '''
+        corners x1, x2, y1, y2 of the pixels of arrays of active areas, in the order of pixelIndex
+        '''
+        ax1, ax2, ay1, ay2 = [np.asarray(v, dtype=float)[:, np.newaxis] for v in (ax1, ax2, ay1, ay2)]
+        pitch_x = (abs(ax2-ax1)-(m-1)*gap)/m + gap
+        pitch_y = (abs(ay2-ay1)-(n-1)*gap)/n + gap
+        iy, ix = np.divmod(np.arange(m*n), m)
+        x1 = ax1 + ix*pitch_x
+        y2 = ay2 - iy*pitch_y
+        return x1.ravel(), (x1 + pitch_x - gap).ravel(), (y2 - pitch_y + gap).ravel(), y2.ravel()
 
-    def move_by(self, x, y):
-        self.x = self.x + x
-        self.y = self.y + y
-        self.setOutline()
-        self.setActiveArea()
+    def getActiveArea(self):
+        return abs((self.ax2-self.ax1)*(self.ay2-self.ay1))
 
     def getPolygon(self, color, active=False):
         '''
         Returns a polygon that can be drawn with matplotlib
         '''
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline if not active else self.activeArea, closed=True, edgecolor='black', facecolor=self.color if not active else 'gray', alpha=0.5,color=color)
 
 
-class Sensor(object):
+class Sensor(SensorBase):
+    __slots__ = ('height', 'width', 'color', 'deadspace', 'n_pixels', 'x_pixel_size', 'y_pixel_size', 'x0', 'y0',
+                 'centers_new_system', 'centers_pixels', 'pixels')
+
     def __init__(self, height, width, x=0, y=0, deadspace=0.5, color='orange'):
         '''
         Create a sensor object with height (in x) and width (in y). x and y define the position of the center
         '''
+        SensorBase.__init__(self, x, y)
         self.height = height
         self.width = width
-        self.x = x
-        self.y = y
         self.color = color
         self.deadspace = deadspace
 
-        self.setOutline()
-
-    def setOutline(self):
+    def getActiveAreaAt(self, x, y):
         '''
-        set the outline for the polygon, but also the coordinates of the corners in an easily accessible way.
-        x1 < x2,
-        y1 < y2
-        so (x1, y1) is the lower left corner.
+        corners (ax1, ax2, ay1, ay2) of the active area if the sensor was centered at x, y (floats or arrays)
         '''
-        self.x1 = self.x - self.height/2.
-        self.x2 = self.x + self.height/2.
-        self.y1 = self.y - self.width/2.
-        self.y2 = self.y + self.width/2.
-
-        self.outline = [
-            [self.x1, self.y2],
-            [self.x2, self.y2],
-            [self.x2, self.y1],
-            [self.x1, self.y1]
-        ]
-
-    def setActiveArea(self):
-        self.ax1 = self.x - self.height/2. + self.deadspace
-        self.ax2 = self.x + self.height/2. - self.deadspace
-        self.ay1 = self.y - self.width/2. + self.deadspace
-        self.ay2 = self.y + self.width/2. - self.deadspace
-
-        self.activeArea = [
-            [self.ax1, self.ay2],
-            [self.ax2, self.ay2],
-            [self.ax2, self.ay1],
-            [self.ax1, self.ay1]
-        ]
+        return (x - self.height/2. + self.deadspace,
+                x + self.height/2. - self.deadspace,
+                y - self.width/2. + self.deadspace,
+                y + self.width/2. - self.deadspace)
 
     def get_pixel_centers(self, m, n, gap):
 
@@ -242,167 +565,168 @@ class Sensor(object):
             pixel.setOutline()
             self.pixels.append(pixel)
 
-    def getActiveArea(self):
-        return abs((self.ax2-self.ax1)*(self.ay2-self.ay1))
+    @staticmethod
+    def pixelIndex(x, y, ax1, ax2, ay1, ay2, m, n, gap):
+        '''
+        analytic version of get_pixel_centers/getPixelsOutline for arrays of points and active areas.
+        pixels start at (ax2, ay1) and are numbered column by column, like centers_pixels.
+        returns the pixel number, -1 for points in the gaps between pixels.
+        '''
+        ix, iy, on_pixel = pixelGrid(ax2-x, y-ay1, ax2-ax1, ay2-ay1, m, n, gap)
+        return np.where(on_pixel, ix*n + iy, -1)
 
-    def move_to(self, x, y):
-        self.x = x
-        self.y = y
-        self.setOutline()
-        self.setActiveArea()
+    @staticmethod
+    def pixelRectangles(ax1, ax2, ay1, ay2, m, n, gap):
+        '''
+        corners x1, x2, y1, y2 of the pixels of arrays of active areas, in the order of pixelIndex
+        '''
+        ax1, ax2, ay1, ay2 = [np.asarray(v, dtype=float)[:, np.newaxis] for v in (ax1, ax2, ay1, ay2)]
+        pitch_x = (abs(ax2-ax1)-(m-1)*gap)/m + gap
+        pitch_y = (abs(ay2-ay1)-(n-1)*gap)/n + gap
+        ix, iy = np.divmod(np.arange(m*n), n)
+        x2 = ax2 - ix*pitch_x
+        y1 = ay1 + iy*pitch_y
+        return (x2 - pitch_x + gap).ravel(), x2.ravel(), y1.ravel(), (y1 + pitch_y - gap).ravel()
 
-    def move_by(self, x, y):
-        self.x = self.x + x
-        self.y = self.y + y
-        self.setOutline()
-        self.setActiveArea()
+    def getActiveArea(self):
+        return abs((self.ax2-self.ax1)*(self.ay2-self.ay1))
 
     def getPolygon(self, active=False):
         '''
         Returns a polygon that can be drawn with matplotlib
         '''
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline if not active else self.activeArea, closed=True, edgecolor='black', facecolor=self.color if not active else 'gray', alpha=0.5)
 
 
 class ReadoutBoard(Sensor):
+    __slots__ = ()
+
     def __init__(self, height, width, x=0, y=0, color='green'):
         '''
         Create a readout board object with height (in x) and width (in y). x and y define the position of the center
         This inherits from Sensor - it's just a rectangle after all
         '''
+        SensorBase.__init__(self, x, y)
         self.height = height
         self.width = width
-        self.x = x
-        self.y = y
         self.color = color
         self.deadspace = 0
 
-        self.setOutline()
-
 
 class PowerBoard(Sensor):
+    __slots__ = ()
+
     def __init__(self, height, width, x=0, y=0, color='red'):
         '''
         Create a power board object with height (in x) and width (in y). x and y define the position of the center.
         This inherits from Sensor - it's just a rectangle after all
         '''
+        SensorBase.__init__(self, x, y)
         self.height = height
         self.width = width
-        self.x = x
-        self.y = y
         self.color = color
         self.deadspace = 0
 
-        self.setOutline()
 
+class Module(Placement):
+    __slots__ = ('height', 'width', 'n_sensor_x', 'n_sensor_y', 'sensor_distance_x', 'sensor_distance_y', 'sensors')
 
-class Module(object):
     def __init__(self, height, width, x=0, y=0, n_sensor_x=1, n_sensor_y=2, sensor_distance_y=22.5, sensor_distance_x=42.6):
         '''
         nSensor can be an even number (or 1).
         Sensor_distance is a measure from center of sensors.
         Symmetry is assumed.
+        The sensors are placed relative to the module, moving the module moves them.
         '''
 
+        Placement.__init__(self, x, y)
         self.height = height
         self.width = width
-        self.x = x
-        self.y = y
         self.n_sensor_x = n_sensor_x
         self.n_sensor_y = n_sensor_y
         self.sensor_distance_x = 0 if n_sensor_x == 1 else sensor_distance_x
         self.sensor_distance_y = 0 if n_sensor_y == 1 else sensor_distance_y
         self.sensors = []
 
-        self.setOutline()
-
-    def setOutline(self):
-        '''
-        set the outline for the polygon, but also the coordinates of the corners in an easily accessible way.
-        x1 < x2,
-        y1 < y2
-        so (x1, y1) is the lower left corner.
-        '''
-        self.x1 = self.x - self.height/2.
-        self.x2 = self.x + self.height/2.
-        self.y1 = self.y - self.width/2.
-        self.y2 = self.y + self.width/2.
-
-        self.outline = [
-            [self.x1, self.y2],
-            [self.x2, self.y2],
-            [self.x2, self.y1],
-            [self.x1, self.y1]
-        ]
-
-        self.getActiveCorners()
-
     def getPolygon(self):
         '''
         Returns a polygon that can be drawn with matplotlib
         '''
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline, fill=True, closed=True, edgecolor='black', linsewidth=2)
 
     def getPolygon2(self, color='blue'):
         '''
         Returns a polygon that can be drawn with matplotlib
         '''
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline, color=color, closed=True, edgecolor='black', alpha=0.6)
 
     def populate(self, sensor):
         for ix in range(self.n_sensor_x):
             for iy in range(self.n_sensor_y):
                 s_temp = copy.deepcopy(sensor)
-                s_temp.move_to((2*ix-1)*self.sensor_distance_x/2 +
-                               self.x, (2*iy-1)*self.sensor_distance_y/2 + self.y)
+                self.attach(s_temp, (2*ix-1)*self.sensor_distance_x/2, (2*iy-1)*self.sensor_distance_y/2)
                 self.sensors.append(s_temp)
 
-    def move_to(self, x, y):
-        self.x = x
-        self.y = y
-        self.setOutline()
-        for s in self.sensors:
-            s.move_to(s.x+x, s.y+y)
-
-    def move_by(self, x, y):
-        self.x = self.x + x
-        self.y = self.y + y
-        self.setOutline()
-        for s in self.sensors:
-            s.move_by(x, y)
+    def copy(self):
+        '''
+        much cheaper than copy.deepcopy, moving the copy does not change the original
+        '''
+        new = copy.copy(self)
+        new.sensors = [copy.copy(s) for s in self.sensors]
+        for s in new.sensors:
+            s.parent = new
+        return new
 
     def getActiveArea(self):
         return sum([s.getActiveArea() for s in self.sensors])
 
     def getActiveCorners(self):
         '''
-        this gets numpy arrays of the corners.
+        this gets lists of the corners.
         in the end, we can check if a particle with (x,y) intersects with the active area of a sensor by doing
         ((m.vax1 < x) & (x < m.vax2) & (m.vay1 < y) & (y < m.vay2)).any()
         '''
-        self.vax1 = [s.ax1 for s in self.sensors]
-        self.vax2 = [s.ax2 for s in self.sensors]
-        self.vay1 = [s.ay1 for s in self.sensors]
-        self.vay2 = [s.ay2 for s in self.sensors]
+        corners = [s.getActiveCorners() for s in self.sensors]
+        return [[c[i] for c in corners] for i in range(4)]
+
+    @property
+    def vax1(self):
+        return self.getActiveCorners()[0]
+
+    @property
+    def vax2(self):
+        return self.getActiveCorners()[1]
+
+    @property
+    def vay1(self):
+        return self.getActiveCorners()[2]
 
+    @property
+    def vay2(self):
+        return self.getActiveCorners()[3]
+
+
+class SuperModule(Placement):
+    __slots__ = ('height', 'width', 'orientation', 'module_gap', 'n_modules', 'color', 'PB', 'RB', '_PB', '_RB',
+                 '_module', 'modules', 'covered')
 
-class SuperModule(object):
     def __init__(self, module, powerboard, readoutboard, x=0, y=0, n_modules=3, module_gap=0.5, orientation='above', color='b'):
         '''
         This consists of N modules together with a readout board and a power board.
+        The modules and boards are placed relative to the supermodule, moving the supermodule moves them.
         '''
 
+        Placement.__init__(self, x, y)
         self.height = module.height * n_modules + module_gap * (n_modules-1)
         self.width = module.width+powerboard.width
-        self.x = x
-        self.y = y
         self.orientation = orientation
         self.module_gap = module_gap
         self.n_modules = n_modules
         self.color = color
 
-        self.setOutline()
-
         # make copies of the components
         self.PB = copy.deepcopy(powerboard)
         self.RB = copy.deepcopy(readoutboard)
@@ -418,57 +742,43 @@ class SuperModule(object):
             m_temp = copy.deepcopy(module)
             m_temp.move_by((-(n_modules-1)/2 + im)*(module.height+module_gap),
                            (-1)*self.PB.width/2 if orientation == 'above' else self.PB.width/2)
+            self.attach(m_temp)
             self.modules.append(m_temp)
 
         # update the dimensions of the RB and PB
         self.PB.height = self.height
-        self.PB.setOutline()
         self.RB.height = self.height
-        self.RB.setOutline()
 
         # move the components in place
         self.PB.move_by(0, self.RB.width/2 if orientation ==
                         'above' else (-1)*self.RB.width/2)
         self.RB.move_by(0, (-1)*self.PB.width/2 if orientation ==
                         'above' else self.PB.width/2)
+        self.attach(self.PB)
+        self.attach(self.RB)
 
     @classmethod
     def fromSuperModule(cls, supermodule, x=0, y=0, n_modules=3, module_gap=0.5, orientation='above', color='b'):
 
         return cls(supermodule._module, supermodule._PB, supermodule._RB, x=x, y=y, n_modules=n_modules, module_gap=module_gap, orientation=orientation, color=color)
 
-    def setOutline(self):
+    def copy(self):
         '''
-        set the outline for the polygon, but also the coordinates of the corners in an easily accessible way.
-        x1 < x2,
-        y1 < y2
-        so (x1, y1) is the lower left corner.
+        much cheaper than copy.deepcopy: the components are copied, the originals (_PB, _RB, _module) are shared
         '''
-        self.x1 = self.x - self.height/2.
-        self.x2 = self.x + self.height/2.
-        self.y1 = self.y - self.width/2.
-        self.y2 = self.y + self.width/2.
-
-        self.outline = [
-            [self.x1, self.y2],
-            [self.x2, self.y2],
-            [self.x2, self.y1],
-            [self.x1, self.y1]
-        ]
-
-    def move_by(self, x, y):
-        self.x = self.x + x
-        self.y = self.y + y
-        self.setOutline()
-        self.RB.move_by(x, y)
-        self.PB.move_by(x, y)
-        for s in self.modules:
-            s.move_by(x, y)
+        new = copy.copy(self)
+        new.PB = copy.copy(self.PB)
+        new.RB = copy.copy(self.RB)
+        new.modules = [m.copy() for m in self.modules]
+        for part in [new.PB, new.RB] + new.modules:
+            part.parent = new
+        return new
 
     def getPolygon(self):
         '''
         Returns a polygon that can be drawn with matplotlib
         '''
+        import matplotlib.pyplot as plt
         return plt.Polygon(self.outline, closed=True, linewidth=3, edgecolor='black', facecolor=self.color, alpha=0.5)
 
     def getActiveArea(self):
@@ -492,21 +802,159 @@ class SuperModule(object):
                      2 if self.orientation == 'above' else self.width/2-self.PB.width/2)
 
 
+class RectangleIndex(object):
+    def __init__(self, x1, x2, y1, y2):
+        '''
+        Row-binned interval index over axis-aligned rectangles (x1 < x < x2, y1 < y < y2).
+        The y axis is cut at every rectangle edge into open slabs and the edges themselves, so every bin
+        is covered by a fixed set of rectangles. Within a bin the rectangles are sorted by x1, together with the
+        running maximum of x2, so a lookup is two binary searches.
+        All comparisons are done on ranks of the original coordinates, so the answers are exactly the ones of
+        the brute force ((x1 < x) & (x < x2) & (y1 < y) & (y < y2)).any()
+        '''
+        self.x1 = x1
+        self.x2 = x2
+        self.y1 = y1
+        self.y2 = y2
+
+        x1 = np.asarray(x1, dtype=float)
+        x2 = np.asarray(x2, dtype=float)
+        y1 = np.asarray(y1, dtype=float)
+        y2 = np.asarray(y2, dtype=float)
+        self.n_rects = len(x1)
+
+        # bin 2i is the open slab (y_edges[i-1], y_edges[i]), bin 2i+1 is the edge y_edges[i] itself
+        self.y_edges = np.unique(np.concatenate([y1, y2]))
+        first_bin = 2*np.searchsorted(self.y_edges, y1) + 2
+        last_bin = 2*np.searchsorted(self.y_edges, y2)
+        n_bins = np.maximum(last_bin - first_bin + 1, 0)
+
+        rect = np.repeat(np.arange(self.n_rects), n_bins)
+        offset = np.arange(len(rect)) - np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+        bins = first_bin[rect] + offset
+
+        # sort by (bin, rank of x1)
+        self.x_edges = np.unique(x1)
+        self.n_ranks = len(self.x_edges) + 1
+        key = bins*self.n_ranks + np.searchsorted(self.x_edges, x1)[rect]
+        order = np.argsort(key, kind='stable')
+        self.keys = key[order]
+        self.bins = bins[order]
+        self.rects = rect[order]
+
+        # running maximum of x2 (and where it was reached) within every bin
+        x2_rank = np.searchsorted(np.unique(x2), x2)[self.rects]
+        running = np.maximum.accumulate(self.bins*(self.n_rects+1) + x2_rank) if len(rect) else x2_rank
+        position = np.arange(len(rect))
+        self.x2_max_at = np.maximum.accumulate(np.where(running == self.bins*(self.n_rects+1) + x2_rank, position, 0)) if len(rect) else position
+        self.x2_max = x2[self.rects[self.x2_max_at]]
+
+        # bins where rectangles overlap in x need a brute force look to report the first rectangle
+        start = np.ones(len(rect), dtype=bool)
+        start[1:] = self.bins[1:] != self.bins[:-1]
+        overlapping = ~start[1:] & (x1[self.rects[1:]] < self.x2_max[:-1])
+        self.overlapping_bins = np.unique(self.bins[1:][overlapping])
+
+        # plain lists for the scalar lookup, bisect on them is much faster than numpy calls on single values
+        self._lists = (self.y_edges.tolist(), self.x_edges.tolist(), self.keys.tolist(), self.bins.tolist(), self.x2_max.tolist(), self.x2_max_at.tolist())
+        self._overlapping = set(self.overlapping_bins.tolist())
+
+    def builtFrom(self, x1, x2, y1, y2):
+        return self.x1 is x1 and self.x2 is x2 and self.y1 is y1 and self.y2 is y2
+
+    def getBins(self, ys):
+        i = np.searchsorted(self.y_edges, ys)
+        on_edge = self.y_edges[np.minimum(i, len(self.y_edges)-1)] == ys if len(self.y_edges) else np.zeros(np.shape(ys), dtype=bool)
+        return 2*i + on_edge
+
+    def query(self, xs, ys):
+        '''
+        returns a boolean mask and the index of the first rectangle hit (-1 for misses) for arrays of points.
+        '''
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        mask = np.zeros(len(xs), dtype=bool)
+        index = np.full(len(xs), -1, dtype=np.int64)
+        if len(self.keys) == 0:
+            return mask, index
+
+        bins = self.getBins(ys)
+        pos = np.searchsorted(self.keys, bins*self.n_ranks + np.searchsorted(self.x_edges, xs)) - 1
+        valid = pos >= 0
+        pos = np.maximum(pos, 0)
+        valid &= self.bins[pos] == bins
+        if instrument.ENABLED:
+            # one rectangle (the one reaching furthest in x) is tested for every point in a bin with rectangles
+            instrument.count('hit_test.points', len(xs))
+            instrument.count('hit_test.rectangles', len(xs)*self.n_rects)
+            instrument.count('hit_test.rectangles_tested', valid.sum())
+        mask[:] = valid & (self.x2_max[pos] > xs)
+        index[mask] = self.rects[self.x2_max_at[pos[mask]]]
+
+        for i in np.nonzero(mask & np.isin(bins, self.overlapping_bins))[0]:
+            index[i] = self.first(xs[i], ys[i], bins[i])
+
+        return mask, index
+
+    def queryOne(self, x, y):
+        '''
+        scalar version of query, returns the index of the first rectangle hit or -1.
+        '''
+        y_edges, x_edges, keys, bins, x2_max, x2_max_at = self._lists
+        i = bisect.bisect_left(y_edges, y)
+        b = 2*i + (i < len(y_edges) and y_edges[i] == y)
+        pos = bisect.bisect_left(keys, b*self.n_ranks + bisect.bisect_left(x_edges, x)) - 1
+        if instrument.ENABLED:
+            instrument.count('hit_test.points')
+            instrument.count('hit_test.rectangles', self.n_rects)
+            instrument.count('hit_test.rectangles_tested', pos >= 0 and bins[pos] == b)
+        if pos < 0 or bins[pos] != b or not x2_max[pos] > x:
+            return -1
+        if b in self._overlapping:
+            return self.first(x, y, b)
+        return self.rects[x2_max_at[pos]]
+
+    def first(self, x, y, b):
+        '''
+        brute force over the rectangles of bin b, only needed where rectangles overlap
+        '''
+        candidates = self.containing(x, y, b)
+        return candidates[0] if len(candidates) else -1
+
+    def containing(self, x, y, b):
+        '''
+        all rectangles of bin b that contain the point, in the order of the rectangles
+        '''
+        lo, hi = np.searchsorted(self.bins, [b, b+1])
+        if instrument.ENABLED:
+            instrument.count('hit_test.rectangles_tested', hi - lo)
+        candidates = np.sort(self.rects[lo:hi])
+        inside = (np.asarray(self.x1)[candidates] < x) & (x < np.asarray(self.x2)[candidates])
+        return candidates[inside]
+
+
 class Dee(object):
     def __init__(self, r_inner, r_outer, z=0, color='red'):
         self.r_inner = r_inner
         self.r_outer = r_outer
         self.area = (r_outer**2 - r_inner**2)*np.pi/2
+        # whether the sensors cover one half of the annulus (populate) or all of it (a face from fromCenters)
+        self.half = None
         self.z = z
         self.color = color
         self.supermodules = []
+        self._index = None
+        self.pixel_grid = None
 
-    def populate(self, supermodule, edge_x=6, shift_x=0, shift_y=0, flavors=[3, 6, 7], center_RB=False, center_PB=False):
+    @instrument.timed('populate')
+    def populate(self, supermodule, edge_x=6, shift_x=0, shift_y=0, flavors=[3, 6, 7], center_RB=False, center_PB=False, materialize=True):
         '''
         takes a supermodule, puts them wherever there's space.
         shift_y = 0 will make the _modules_ symmetric around the y-axis.
         shift_y = module.width/2 would then be the second Dee, for example.
+        materialize is passed on to getAllCorners2, materialize=False is much faster for scans of the parameters.
         '''
+        self.half = True
         smallest = SuperModule.fromSuperModule(
             supermodule, n_modules=1, module_gap=supermodule.module_gap, orientation=supermodule.orientation)
         if center_RB:
@@ -519,39 +967,38 @@ class Dee(object):
         self.n_columns = int(
             self.r_outer/(smallest.height+smallest.module_gap))+2
 
-        #self.slot_matrix = np.zeros((self.n_rows,self.n_columns))
-        self.slot_matrix = [
-            [0 for x in range(self.n_columns)] for y in range(self.n_rows)]
+        # shifts of the slots w.r.t. smallest, for all rows and columns at once
+        dx = np.arange(self.n_columns)*(smallest.height+smallest.module_gap)
+        dy = (math.floor(self.n_rows/2)-np.arange(self.n_rows))*smallest.width
+        x1 = ((smallest.x + dx) - smallest.height/2.)[np.newaxis, :]
+        x2 = ((smallest.x + dx) + smallest.height/2.)[np.newaxis, :]
+        y1 = ((smallest.y + dy) - smallest.width/2.)[:, np.newaxis]
+        y2 = ((smallest.y + dy) + smallest.width/2.)[:, np.newaxis]
+
+        # all four corners on the disk
+        on_disk = np.ones((self.n_rows, self.n_columns), dtype=bool)
+        for cx, cy in [(x1, y1), (x2, y2), (x1, y2), (x2, y1)]:
+            r2 = cx**2 + cy**2
+            on_disk &= (r2 > self.r_inner**2) & (r2 < self.r_outer**2)
+
+        # rows are counted from the top
+        self.slot_matrix = on_disk[::-1].astype(int).tolist()
 
         self.slots = [[] for y in range(self.n_rows)]
 
-        for row in range(self.n_rows):
-            for column in range(self.n_columns):
-                # SuperModule.fromSuperModule(smallest, x=smallest.x, y=smallest.y, n_modules=1, module_gap=smallest.module_gap, orientation=smallest.orientation)
-                tmp = copy.deepcopy(smallest)
-                tmp.move_by(column*(smallest.height+smallest.module_gap),
-                            (math.floor(self.n_rows/2)-row)*smallest.width)
-                if (tmp.x1**2 + tmp.y1**2) > self.r_inner**2 and \
-                   (tmp.x2**2 + tmp.y2**2) > self.r_inner**2 and \
-                   (tmp.x1**2 + tmp.y2**2) > self.r_inner**2 and \
-                   (tmp.x2**2 + tmp.y1**2) > self.r_inner**2 and \
-                   (tmp.x1**2 + tmp.y1**2) < self.r_outer**2 and \
-                   (tmp.x2**2 + tmp.y2**2) < self.r_outer**2 and \
-                   (tmp.x1**2 + tmp.y2**2) < self.r_outer**2 and \
-                   (tmp.x2**2 + tmp.y1**2) < self.r_outer**2:
-
-                    # NOW apply the shift, otherwise we mess up the "on-disk" requirement. This can cause weirdness in the plots.
-                    tmp.move_by(shift_x, shift_y)
-
-                    self.slots[self.n_rows-row-1].append(tmp)
-
-                    self.slot_matrix[self.n_rows-row-1][column] = 1
-                else:
-                    self.slot_matrix[self.n_rows-row-1][column] = 0
+        dx, dy = dx.tolist(), dy.tolist()
+        for row, column in zip(*np.nonzero(on_disk)):
+            tmp = smallest.copy()
+            tmp.move_by(dx[column], dy[row])
+            # NOW apply the shift, otherwise we mess up the "on-disk" requirement. This can cause weirdness in the plots.
+            tmp.move_by(shift_x, shift_y)
+            self.slots[self.n_rows-row-1].append(tmp)
 
         # now let's go through the matrix again and see which slots we can actually populate
         self.module_matrix = []
         self.slots_flat = []
+        # one supermodule per flavor, the placed ones are copies of it
+        templates = {}
         for i, row in enumerate(self.slot_matrix):
             # maximum length
             length = sum(row)
@@ -562,14 +1009,14 @@ class Dee(object):
 
             x_shift = 0
             for k, n_mod in enumerate(partition):
-                tmp = copy.deepcopy(SuperModule.fromSuperModule(
-                    supermodule, n_modules=n_mod, module_gap=supermodule.module_gap, orientation=supermodule.orientation, color=colors[n_mod]))
+                if n_mod not in templates:
+                    templates[n_mod] = SuperModule.fromSuperModule(
+                        supermodule, n_modules=n_mod, module_gap=supermodule.module_gap, orientation=supermodule.orientation, color=colors[n_mod])
+                tmp = templates[n_mod].copy()
                 tmp.move_by(self.slots[i][0].x1-tmp.x1 +
                             x_shift, self.slots[i][0].y1-tmp.y1)
                 x_shift += tmp.height + tmp.module_gap
                 self.supermodules.append(tmp)
-                # break
-                # self.slots[i][0].x1
 
             for j in range(length):
                 self.slots[i][j].covered = True if j < covered else False
@@ -582,45 +1029,47 @@ class Dee(object):
                 self.module_matrix.append(
                     [1]*covered + [-1]*(length-covered) + [0]*(len(row)-length))
 
-        self.getAllCorners2(2, 2, 0.1)
+        self.getAllCorners2(2, 2, 0.1, materialize=materialize)
 
         return
 
-    def fromCenters(self, centers, sensor):
+    @instrument.timed('fromCenters')
+    def fromCenters(self, centers, sensor, materialize=True, half=False):
         '''
         this is useful for old layouts / tilings
-
+        centers can be a list of (x, y) or an (N, 2) array, e.g. from layout.load_layout
+        with materialize=False only the corner arrays are filled, without the Sensor objects (sensors stays empty).
+        half=True if the centers only cover one half of the annulus (the default is a full face, see getFillFactor)
         '''
-        # loop over centers
+        centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        self.half = half
+
+        # the corners are computed for all centers at once
+        self._index = None
+        self.pixel_grid = None
+        self.vax1, self.vax2, self.vay1, self.vay2 = sensor.getActiveAreaAt(centers[:, 0], centers[:, 1])
+
+        # sensor objects, e.g. for plotting. a shallow copy is enough, move_to replaces all the coordinates
         self.sensors = []
-        for x, y in centers:
-            tmp = copy.deepcopy(sensor)
+        if not materialize:
+            return
+        for x, y in centers.tolist():
+            tmp = copy.copy(sensor)
             tmp.move_to(x, y)
             self.sensors.append(tmp)
 
-        # manually get the corners
-        self.vax1 = []
-        self.vax2 = []
-        self.vay1 = []
-        self.vay2 = []
-
-        for sen in self.sensors:
-
-            self.vax1 += [sen.ax1]
-            self.vax2 += [sen.ax2]
-            self.vay1 += [sen.ay1]
-            self.vay2 += [sen.ay2]
-
-        self.vax1 = np.array(self.vax1)
-        self.vax2 = np.array(self.vax2)
-        self.vay1 = np.array(self.vay1)
-        self.vay2 = np.array(self.vay2)
-
-    def fromCenters2(self, centers, sensor, m_sens, n_sens, gap_pixel):
+    @instrument.timed('fromCenters2')
+    def fromCenters2(self, centers, sensor, m_sens, n_sens, gap_pixel, materialize=True, half=False):
         '''
         this is useful for old layouts / tilings
-
+        with materialize=False the Pixel objects are not built, the pixels are found arithmetically by intersect instead (see setPixels).
         '''
+        if not materialize:
+            self.fromCenters(centers, sensor, half=half)
+            self.setPixels(m_sens, n_sens, gap_pixel, sensor_type=type(sensor))
+            return
+
+        self.half = half
         # loop over centers
         self.m_sens = m_sens
         self.n_sens = n_sens
@@ -632,6 +1081,8 @@ class Dee(object):
             self.sensors.append(tmp)
 
         # manually get the corners
+        self._index = None
+        self.pixel_grid = None
         self.vax1 = []
         self.vax2 = []
         self.vay1 = []
@@ -653,6 +1104,8 @@ class Dee(object):
         self.vay2 = np.array(self.vay2)
 
     def getAllCorners(self):
+        self._index = None
+        self.pixel_grid = None
         self.vax1 = []
         self.vax2 = []
         self.vay1 = []
@@ -672,7 +1125,18 @@ class Dee(object):
         self.vay1 = np.array(self.vay1)
         self.vay2 = np.array(self.vay2)
 
-    def getAllCorners2(self, m_sens, n_sens, gap_pixel):
+    @instrument.timed('getAllCorners2')
+    def getAllCorners2(self, m_sens, n_sens, gap_pixel, materialize=True):
+        '''
+        with materialize=False the Pixel objects are not built, the pixels are found arithmetically by intersect instead (see setPixels).
+        '''
+        if not materialize:
+            self.getAllCorners()
+            self.setPixels(m_sens, n_sens, gap_pixel, sensor_type=type(self.slots_flat[0].modules[0].sensors[0]) if self.slots_flat else Sensor)
+            return
+
+        self._index = None
+        self.pixel_grid = None
         self.vax1 = []
         self.vax2 = []
         self.vay1 = []
@@ -699,14 +1163,226 @@ class Dee(object):
         self.vay1 = np.array(self.vay1)
         self.vay2 = np.array(self.vay2)
 
+    def getIndex(self):
+        '''
+        returns the RectangleIndex over vax1/vax2/vay1/vay2, rebuilt whenever the corner arrays were replaced.
+        '''
+        if self._index is None or not self._index.builtFrom(self.vax1, self.vax2, self.vay1, self.vay2):
+            with instrument.stage('build_index'):
+                self._index = RectangleIndex(self.vax1, self.vax2, self.vay1, self.vay2)
+        return self._index
+
+    def setPixels(self, m_sens, n_sens, gap_pixel, sensor_type=None):
+        '''
+        pixel-aware hit test without building Pixel objects.
+        vax1/vax2/vay1/vay2 stay the sensor active areas, intersect finds the sensor and then computes the pixel (row, column)
+        from the position in the sensor, the pixel pitch and the gap. hits in the gaps between pixels are misses.
+        pixel numbers follow the order of fromCenters2/getAllCorners2 (sensor_type.pixelIndex).
+        '''
+        if sensor_type is None:
+            sensor_type = type(self.sensors[0]) if getattr(self, 'sensors', None) else Sensor
+        self.m_sens = m_sens
+        self.n_sens = n_sens
+        self.gap_pixel = gap_pixel
+        self.pixel_grid = (m_sens, n_sens, gap_pixel, sensor_type)
+
+    def getPixels(self, xs, ys, sensor):
+        '''
+        pixel numbers (counted over the whole Dee, like the rectangles of fromCenters2) for points inside the given sensors, -1 in the gaps
+        '''
+        m, n, gap, sensor_type = self.pixel_grid
+        local = sensor_type.pixelIndex(xs, ys, self.vax1[sensor], self.vax2[sensor], self.vay1[sensor], self.vay2[sensor], m, n, gap)
+        return np.where(local >= 0, sensor*m*n + local, -1)
+
+    def getActiveRectangles(self):
+        '''
+        corners of the active rectangles: the pixels if setPixels was used, vax1/vax2/vay1/vay2 otherwise
+        '''
+        if self.pixel_grid is None:
+            return self.vax1, self.vax2, self.vay1, self.vay2
+        m, n, gap, sensor_type = self.pixel_grid
+        return sensor_type.pixelRectangles(self.vax1, self.vax2, self.vay1, self.vay2, m, n, gap)
+
+    def getCoveredArea(self, radii):
+        '''
+        exact area covered by the active rectangles (overlaps counted once) inside each of the increasing radii
+        '''
+        return radialArea(*coveredRectangles(*self.getActiveRectangles()), radii)
+
+    def getFillFactor(self, half=None):
+        '''
+        fraction of the annulus between r_inner and r_outer that is covered by active area.
+        the reference is the half annulus of a Dee (self.area) with half=True, the full annulus with half=False.
+        by default it is self.half, which populate (half) and fromCenters (full face, unless told otherwise) set
+        '''
+        if half is None:
+            half = self.half
+        if half is None:
+            raise ValueError('the Dee has no sensors yet, fill it with populate or fromCenters or pass half')
+        inner, outer = self.getCoveredArea([self.r_inner, self.r_outer])
+        return (outer - inner)/(self.area if half else 2*self.area)
+
     def intersect(self, x, y):
         '''
         ((m.vax1 < x) & (x < m.vax2) & (m.vay1 < y) & (y < m.vay2)).any()
+        evaluated with the spatial index, so the cost is logarithmic in the number of rectangles.
         '''
-        return ((self.vax1 < x) & (x < self.vax2) & (self.vay1 < y) & (y < self.vay2)).any()
+        index = self.getIndex()
+        hit = index.queryOne(x, y)
+        if hit >= 0 and self.pixel_grid is not None:
+            pixel = self.getPixels(x, y, hit)
+            if pixel < 0 and index.overlapping_bins.size:
+                pixel = self.getOverlappingPixel(x, y, index.getBins(y))
+            return pixel >= 0
+        return hit >= 0
+
+    def getOverlappingPixel(self, x, y, b):
+        '''
+        the pixel hit by a point in bin b of the index where sensors overlap: the first of the sensors containing the
+        point that has a pixel there (as the pixel rectangles of fromCenters2), -1 if the point is in the gaps of all
+        '''
+        index = self.getIndex()
+        if b not in index._overlapping:
+            return -1
+        for sensor in index.containing(x, y, b):
+            pixel = self.getPixels(np.array([x]), np.array([y]), np.array([sensor]))[0]
+            if pixel >= 0:
+                return pixel
+        return -1
+
+    @instrument.timed('hit_test')
+    def intersect_many(self, xs, ys, return_index=False, chunk_size=None):
+        '''
+        batched version of intersect for arrays of hit positions.
+        returns a boolean mask with the same answer as intersect(x, y) for every point.
+        with return_index=True also returns the index into vax1/vax2/vay1/vay2 (sensor, or pixel after fromCenters2)
+        of the first rectangle that was hit, or the pixel number after setPixels, -1 for misses.
+        points are processed in chunks of chunk_size to keep the temporary arrays bounded.
+        '''
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        index = self.getIndex()
+
+        mask = np.zeros(len(xs), dtype=bool)
+        hit = np.full(len(xs), -1, dtype=np.int64)
+
+        if chunk_size is None:
+            chunk_size = MAX_CHUNK_ELEMENTS
+
+        for start in range(0, len(xs), chunk_size):
+            chunk = slice(start, start+chunk_size)
+            mask[chunk], hit[chunk] = index.query(xs[chunk], ys[chunk])
+
+            if self.pixel_grid is not None:
+                sensor = hit[chunk]
+                on_sensor = sensor >= 0
+                pixel = np.full(len(sensor), -1, dtype=np.int64)
+                pixel[on_sensor] = self.getPixels(xs[chunk][on_sensor], ys[chunk][on_sensor], sensor[on_sensor])
+                if index.overlapping_bins.size:
+                    # in a gap of the first sensor, but maybe on a pixel of another sensor overlapping it
+                    gap = np.nonzero(on_sensor & (pixel < 0))[0]
+                    bins = index.getBins(ys[chunk][gap])
+                    for i, b in zip(gap[np.isin(bins, index.overlapping_bins)], bins[np.isin(bins, index.overlapping_bins)]):
+                        pixel[i] = self.getOverlappingPixel(xs[chunk][i], ys[chunk][i], b)
+                mask[chunk] = pixel >= 0
+                hit[chunk] = pixel
+
+        return (mask, hit) if return_index else mask
+
+
+class Propagation(object):
+    def __init__(self, n_layers, n_tracks, positions=True, return_index=False):
+        '''
+        Result of propagate: hits[i] is the hit mask of layer i, x[i] and y[i] the track positions on layer i,
+        index[i] the sensor/pixel that was hit (-1 for misses) and nHits the number of layers hit by every track.
+        '''
+        self.n_layers = n_layers
+        self.n_tracks = n_tracks
+        self.hits = np.zeros((n_layers, n_tracks), dtype=bool)
+        self.nHits = np.zeros(n_tracks, dtype=np.int16)
+        self.x = np.zeros((n_layers, n_tracks)) if positions else None
+        self.y = np.zeros((n_layers, n_tracks)) if positions else None
+        self.index = np.full((n_layers, n_tracks), -1, dtype=np.int64) if return_index else None
+
+    def getEfficiency(self, min_hits=1):
+        '''
+        fraction of tracks with at least min_hits hits
+        '''
+        return (self.nHits >= min_hits).sum()/max(self.n_tracks, 1)
+
+
+@instrument.timed('propagate')
+def layerPositions(z, eta, phi, z_ref=None, z_track=3000., z_scale=1000.):
+    '''
+    positions of straight tracks on layers at z, see propagate.
+    returns the arrays x, y with shape (len(z), len(eta))
+    '''
+    eta = np.asarray(eta, dtype=float).ravel()
+    phi = np.asarray(phi, dtype=float).ravel()
+    if z_ref is None:
+        z_ref = z[0]
+
+    tan_theta = np.tan(2*np.arctan(np.exp(-eta)))
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+    r = z_track*tan_theta
+
+    x = np.empty((len(z), len(eta)))
+    y = np.empty((len(z), len(eta)))
+    for i, z_layer in enumerate(z):
+        shift = z_scale*(z_layer-z_ref)*tan_theta
+        x[i] = r*cos_phi + shift*cos_phi
+        y[i] = r*sin_phi + shift*sin_phi
+    return x, y
+
+
+def propagate(layers, z, eta, phi, z_ref=None, z_track=3000., z_scale=1000., positions=True, return_index=False, chunk_size=None, hits=None):
+    '''
+    Propagates straight tracks given by arrays of eta and phi through the layers (Dees) at the positions z.
+    Like the event loop in geometric_acceptance.ipynb the track position is computed at z_track (in mm) and shifted to every
+    layer by z_scale*(z[i]-z_ref)*tan(theta), so z can be given in m (z_scale=1000) as in the notebooks.
+    z_ref defaults to the first layer.
+    Tracks are processed in chunks of chunk_size, set positions=False to not keep the hit positions.
+    hits is an optional hits.HitWriter, every chunk is then also written to its hit table.
+    returns a Propagation.
+    '''
+    eta = np.asarray(eta, dtype=float).ravel()
+    phi = np.asarray(phi, dtype=float).ravel()
+    if z_ref is None:
+        z_ref = z[0]
+    if chunk_size is None:
+        chunk_size = MAX_CHUNK_ELEMENTS
+
+    result = Propagation(len(layers), len(eta), positions=positions, return_index=return_index or hits is not None)
+    if hits is not None:
+        # positions of the layers in mm and number of pixels per sensor
+        z_hits = [z_track + z_scale*(z_layer-z_ref) for z_layer in z]
+        pixels = [0 if layer.pixel_grid is None else layer.pixel_grid[0]*layer.pixel_grid[1] for layer in layers]
+
+    for start in range(0, len(eta), chunk_size):
+        chunk = slice(start, start+chunk_size)
+        xs, ys = layerPositions(z, eta[chunk], phi[chunk], z_ref=z_ref, z_track=z_track, z_scale=z_scale)
+
+        for i, layer in enumerate(layers):
+            if result.index is not None:
+                result.hits[i, chunk], result.index[i, chunk] = layer.intersect_many(xs[i], ys[i], return_index=True)
+            else:
+                result.hits[i, chunk] = layer.intersect_many(xs[i], ys[i])
+            if positions:
+                result.x[i, chunk] = xs[i]
+                result.y[i, chunk] = ys[i]
+
+        if hits is not None:
+            hits.writeChunk(result.hits[:, chunk], result.index[:, chunk], xs, ys, z_hits, pixels=pixels,
+                            eta=eta[chunk], phi=phi[chunk])
+
+    result.nHits[:] = result.hits.sum(axis=0)
+
+    return result
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
 
     # run an example
     # current TAMALES
@@ -733,27 +1409,13 @@ if __name__ == "__main__":
     # for row in D.slot_matrix:
     #    print ((' '.join([ str(x) for x in row])).replace('1','X').replace('0', '.'))
 
-    inner = plt.Circle((0, 0), 315, fill=None, edgecolor='r')
-    outer = plt.Circle((0, 0), 1185, fill=None, edgecolor='r')
-
     plt.rcParams['figure.figsize'] = [15, 15]
 
-    plt.gca().add_patch(inner)
-    plt.gca().add_patch(outer)
-
-    i = 0
-    for row in D.slots:
-        for sm in row:
-            for mod in sm.modules:
-                for sen in mod.sensors:
-                    for pix in sen.pixels:
-                        plt.gca().add_patch(pix.getPolygon())
+    # all the pixels in one collection, see render.py
+    from render import draw_dee
+    draw_dee(D, layers=('active',), styles={'active': dict(facecolor='blue', edgecolor='black', alpha=0.6)})
 
-    # for row in D.slots:
-    #     for sm in row:
-    #         for mod in sm.modules:
-    #             for sen in mod.sensors:
-    #                 plt.gca().add_patch(sen.getPolygon())
+    # draw_dee(D, layers=('sensors',))
 
     plt.axis('scaled')
     plt.show()
@@ -761,14 +1423,13 @@ if __name__ == "__main__":
     #     print((' '.join([str(x) for x in row])).replace(
     #         '-1', 'O').replace('0', '.').replace('1', 'X'))
 
-    # covered_area = sum([slot.getActiveArea() for slot in D.slots_flat])
-    # available_slots = sum([sum(row) for row in D.slot_matrix])
-    # filled_slots = sum([sum([x for x in row if x == 1])
-    #                    for row in D.module_matrix])
+    available_slots = sum([sum(row) for row in D.slot_matrix])
+    filled_slots = sum([sum([x for x in row if x == 1])
+                       for row in D.module_matrix])
 
-    # print("Number of available slots:", available_slots)
-    # print("Number of used slots (= number of modules):", filled_slots)
-    # print("The maximum fill factor is:", round(covered_area/D.area, 3))
+    print("Number of available slots:", available_slots)
+    print("Number of used slots (= number of modules):", filled_slots)
+    print("The fill factor is:", round(D.getFillFactor(), 3))
 
     # print("Testing if a particle at 10,10 intersects any of the sensors (it shouldn't):",
     #       D.intersect(10, 10))
@@ -0,0 +1,633 @@
+from statistics import NormalDist
+
+import numpy as np
+
+import instrument
+from cache import ResultCache, dee_key
+from hits import HitTable, HitWriter
+from ETL import Sensor2, TrackBatch, coveredRectangles, layerPositions, propagate, radialArea
+from layout import sensor_centers
+
+
+# layers of the ETL databases, in the order D1 - D4, and their positions in m (as in the notebooks)
+LAYERS = [('disk1', 'front'), ('disk1', 'back'), ('disk2', 'front'), ('disk2', 'back')]
+Z_LAYERS = [2.99825, 3.0055, 3.02075, 3.0285]
+
+ETA_MIN = 1.659
+ETA_MAX = 2.950
+
+# number of events generated and propagated at once by stream_histograms
+CHUNK_SIZE = 2**18
+
+# (n_bins, low, high) of the efficiency plots in the notebooks
+BINS = {
+    'eta': (40, ETA_MIN, ETA_MAX),
+    'r': (50, 300, 1200),
+    'phi': (40, -np.pi, np.pi),
+}
+
+# (var_x, bins_x, var_y, bins_y) of the 2D efficiency maps
+MAPS = {
+    'xy': ('x', (48, -1200, 1200), 'y', (48, -1200, 1200)),
+}
+
+# probability content of the efficiency intervals
+ONE_SIGMA = 0.6826894921370859
+
+
+def radical_inverse(index, base):
+    '''
+    van der Corput sequence in base for an array of (positive) indices
+    '''
+    index = np.array(index, dtype=np.int64)
+    result = np.zeros(len(index))
+    f = 1.
+    while (index > 0).any():
+        f /= base
+        result += f*(index % base)
+        index //= base
+    return result
+
+
+def halton(n, start=0, bases=(2, 3)):
+    '''
+    points start ... start+n-1 of the Halton sequence, shape (len(bases), n)
+    '''
+    index = np.arange(start+1, start+n+1)
+    return np.array([radical_inverse(index, base) for base in bases])
+
+
+@instrument.timed('generate_events')
+def generate_events(n_events, seed, eta_min=ETA_MIN, eta_max=ETA_MAX, method='random', start=0):
+    '''
+    flat in eta and phi, like the event generation in the notebooks, but reproducible from the seed
+    (an int or a numpy SeedSequence).
+    method='random' draws independent events as the notebooks do.
+    method='stratified' draws a latin hypercube: every 1/n_events slice of eta and of phi gets exactly one event.
+    method='halton' takes the events start ... start+n_events-1 of the Halton sequence, randomly shifted (modulo 1)
+    by the seed, so that different seeds give independent estimates.
+    returns the arrays eta, phi
+    '''
+    rng = np.random.default_rng(seed)
+    if method == 'random':
+        u_eta = rng.random(n_events)
+        u_phi = rng.random(n_events)
+    elif method == 'stratified':
+        u_eta = (rng.permutation(n_events) + rng.random(n_events))/n_events
+        u_phi = (rng.permutation(n_events) + rng.random(n_events))/n_events
+    elif method == 'halton':
+        u_eta, u_phi = (halton(n_events, start=start) + rng.random((2, 1))) % 1.
+    else:
+        raise ValueError("method has to be 'random', 'stratified' or 'halton', not %s" % method)
+    eta = u_eta*(eta_max-eta_min) + eta_min
+    phi = u_phi*2*np.pi - np.pi
+    return eta, phi
+
+
+def wilson_interval(k, n, level=ONE_SIGMA):
+    '''
+    Wilson score interval of the efficiency k/n (arrays), (0, 1) where n is 0
+    '''
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    z = NormalDist().inv_cdf(0.5 + level/2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = k/n
+        denominator = 1 + z**2/n
+        center = (p + z**2/(2*n))/denominator
+        half = z*np.sqrt(p*(1-p)/n + z**2/(4*n**2))/denominator
+    return np.where((n > 0) & (k > 0), center - half, 0.), np.where((n > 0) & (k < n), center + half, 1.)
+
+
+def clopper_pearson_interval(k, n, level=ONE_SIGMA):
+    '''
+    exact (Clopper-Pearson) interval of the efficiency k/n (arrays), (0, 1) where n is 0. needs scipy
+    '''
+    from scipy.stats import beta
+
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    alpha = 1 - level
+    with np.errstate(divide='ignore', invalid='ignore'):
+        low = np.where(k > 0, beta.ppf(alpha/2, k, n-k+1), 0.)
+        high = np.where(k < n, beta.ppf(1-alpha/2, k+1, n-k), 1.)
+    return np.where(n > 0, low, 0.), np.where(n > 0, high, 1.)
+
+
+def efficiency_interval(k, n, method='wilson', level=ONE_SIGMA):
+    '''
+    interval of the efficiency k/n with method 'wilson', 'clopper-pearson' or 'normal' (eff +- sqrt(eff*(1-eff)/n))
+    '''
+    if method == 'wilson':
+        return wilson_interval(k, n, level=level)
+    if method == 'clopper-pearson':
+        return clopper_pearson_interval(k, n, level=level)
+    if method == 'normal':
+        k = np.asarray(k, dtype=float)
+        n = np.asarray(n, dtype=float)
+        z = NormalDist().inv_cdf(0.5 + level/2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = k/n
+            error = z*np.sqrt(p*(1-p)/n)
+        return p - error, p + error
+    raise ValueError("method has to be 'wilson', 'clopper-pearson' or 'normal', not %s" % method)
+
+
+def binIndex(values, edges):
+    '''
+    bin of every value with the convention of np.histogram (the last bin includes its upper edge), -1 outside.
+    the edges are the uniform ones of np.linspace, so the bin is computed, and only corrected where the rounding puts
+    a value next to an edge into the wrong bin
+    '''
+    values = np.asarray(values, dtype=float)
+    n_bins = len(edges) - 1
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    index = (np.where(inside, values - edges[0], 0.)*(n_bins/(edges[-1] - edges[0]))).astype(np.int64)
+    np.clip(index, 0, n_bins-1, out=index)
+    index -= values < edges[index]
+    index += (values >= edges[index+1]) & (index != n_bins-1)
+    index[~inside] = -1
+    return index
+
+
+class EfficiencyHistograms(object):
+    def __init__(self, variants=('hit',), bins=None, maps=None):
+        '''
+        Numerator and denominator counts of several efficiencies at once (variants, e.g. hit in layer 1, 2, ... or
+        at least one hit) vs the variables of bins (name -> (n_bins, low, high), by default BINS: eta, r and phi)
+        and 2D maps (name -> (var_x, (n_bins, low, high), var_y, (n_bins, low, high)), by default MAPS: y vs x).
+        fill takes the track arrays and the masks of the tracks that pass every variant, every histogram is one
+        bincount for all variants. The counts are integers, so histograms of different event shards can be added exactly.
+        den[name] has the shape of the histogram, num[name] one more dimension for the variants in front.
+        '''
+        self.variants = list(variants)
+        self.bins = dict(BINS, **(bins or {}))
+        self.maps = dict(MAPS if maps is None else maps)
+        self.edges = {}
+        self.den = {}
+        self.num = {}
+        for var, (n_bins, low, high) in self.bins.items():
+            self.edges[var] = np.linspace(low, high, n_bins+1)
+        for name, (var_x, bins_x, var_y, bins_y) in self.maps.items():
+            self.edges[name] = (np.linspace(bins_x[1], bins_x[2], bins_x[0]+1), np.linspace(bins_y[1], bins_y[2], bins_y[0]+1))
+        for name in self.getNames():
+            shape = self.getShape(name)
+            self.den[name] = np.zeros(shape, dtype=np.int64)
+            self.num[name] = np.zeros((len(self.variants),) + shape, dtype=np.int64)
+
+    def getNames(self):
+        return list(self.bins) + list(self.maps)
+
+    def getShape(self, name):
+        if name in self.maps:
+            return (self.maps[name][1][0], self.maps[name][3][0])
+        return (self.bins[name][0],)
+
+    def getVariant(self, variant):
+        return variant if isinstance(variant, (int, np.integer)) else self.variants.index(variant)
+
+    def getBinIndex(self, tracks):
+        '''
+        name -> flat bin index of every track (-1 outside), tracks is a TrackBatch or anything with the variables as
+        attributes or items
+        '''
+        def values(var):
+            return tracks[var] if isinstance(tracks, dict) else getattr(tracks, var)
+
+        index = {}
+        for var in self.bins:
+            index[var] = binIndex(values(var), self.edges[var])
+        for name, (var_x, bins_x, var_y, bins_y) in self.maps.items():
+            edges_x, edges_y = self.edges[name]
+            ix = binIndex(values(var_x), edges_x)
+            iy = binIndex(values(var_y), edges_y)
+            index[name] = np.where((ix >= 0) & (iy >= 0), ix*bins_y[0] + iy, -1)
+        return index
+
+    @instrument.timed('histograms')
+    def fill(self, tracks, passed, index=None):
+        '''
+        adds the tracks to the denominators, and the ones that pass to the numerators.
+        passed is a boolean array (n_variants, n_tracks), or (n_tracks) for a single variant.
+        index is the optional result of getBinIndex(tracks)
+        '''
+        passed = np.asarray(passed, dtype=bool).reshape(len(self.variants), -1)
+        if index is None:
+            index = self.getBinIndex(tracks)
+        for name, bin_index in index.items():
+            size = self.den[name].size
+            inside = bin_index >= 0
+            bin_index = bin_index[inside]
+            self.den[name] += np.bincount(bin_index, minlength=size).reshape(self.den[name].shape)
+            variant, track = np.nonzero(passed[:, inside])
+            self.num[name] += np.bincount(variant*size + bin_index[track], minlength=len(self.variants)*size).reshape(self.num[name].shape)
+
+    def __iadd__(self, other):
+        for name in self.getNames():
+            self.num[name] += other.num[name]
+            self.den[name] += other.den[name]
+        return self
+
+    def getCounts(self, name, variant=0):
+        '''
+        numerator and denominator of a histogram for one variant (index or name)
+        '''
+        return self.num[name][self.getVariant(variant)], self.den[name]
+
+    def getEfficiency(self, name, variant=0):
+        k, n = self.getCounts(name, variant)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return k/n
+
+    def getInterval(self, name, variant=0, method='wilson', level=ONE_SIGMA):
+        '''
+        lower and upper end of the interval of the efficiency, see efficiency_interval
+        '''
+        return efficiency_interval(*self.getCounts(name, variant), method=method, level=level)
+
+    def getErrors(self, name, variant=0, method='wilson', level=ONE_SIGMA):
+        '''
+        the (asymmetric) errors below and above the efficiency, e.g. for plt.errorbar(yerr=...)
+        '''
+        efficiency = self.getEfficiency(name, variant)
+        low, high = self.getInterval(name, variant, method=method, level=level)
+        return efficiency - low, high - efficiency
+
+
+class AcceptanceHistograms(EfficiencyHistograms):
+    def __init__(self, n_layers=len(LAYERS), bins=None, maps=None):
+        '''
+        Efficiency of tracks with at least one hit (the variant 'hit') vs eta, r, phi and y vs x at the reference plane,
+        and the distribution of the number of hits.
+        '''
+        EfficiencyHistograms.__init__(self, variants=('hit',), bins=bins, maps=maps)
+        self.n_layers = n_layers
+        self.nHits = np.zeros(n_layers+1, dtype=np.int64)
+
+    def fill(self, tracks, nHits, index=None):
+        '''
+        tracks is a TrackBatch (positions at the reference plane), nHits the number of hits of every track
+        '''
+        nHits = np.asarray(nHits)
+        EfficiencyHistograms.fill(self, tracks, nHits > 0, index=index)
+        self.nHits += np.bincount(nHits, minlength=self.n_layers+1)
+
+    def __iadd__(self, other):
+        EfficiencyHistograms.__iadd__(self, other)
+        self.nHits += other.nHits
+        return self
+
+    def getEfficiency(self, var=None):
+        '''
+        efficiency per bin of var, or the overall efficiency (at least one hit) if var is None
+        '''
+        if var is None:
+            return self.nHits[1:].sum()/max(self.nHits.sum(), 1)
+        return EfficiencyHistograms.getEfficiency(self, var)
+
+    def getCounts(self, var=None, variant=0):
+        if var is None:
+            return self.nHits[1:].sum(), self.nHits.sum()
+        return EfficiencyHistograms.getCounts(self, var, variant)
+
+    def getError(self, var=None):
+        '''
+        binomial uncertainty sqrt(eff*(1-eff)/n) of getEfficiency
+        '''
+        efficiency = self.getEfficiency(var)
+        n = self.getCounts(var)[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(efficiency*(1-efficiency)/n)
+
+    def getFractions(self):
+        '''
+        fraction of tracks with 0, 1, ... n_layers hits
+        '''
+        return self.nHits/max(self.nHits.sum(), 1)
+
+
+def fill_histograms(layers, eta, phi, z=Z_LAYERS, z_track=3000., histograms=None, bins=None):
+    '''
+    propagates the tracks through the layers and adds them to (new or given) AcceptanceHistograms
+    '''
+    if histograms is None:
+        histograms = AcceptanceHistograms(n_layers=len(layers), bins=bins)
+    result = propagate(layers, z, eta, phi, z_track=z_track, positions=False)
+    histograms.fill(TrackBatch.fromEtaPhi(eta, phi, z_track), result.nHits)
+    return histograms
+
+
+def fill_layer_histograms(layers, eta, phi, z=Z_LAYERS, z_track=3000., histograms=None, bins=None, maps=None, names=None):
+    '''
+    propagates the tracks through the layers and adds them to (new or given) EfficiencyHistograms with the variants
+    hit in every layer (named by names, by default D1, D2, ...) and 'any' (at least one hit), all in one fill
+    '''
+    if names is None:
+        names = ['D%d' % (i+1) for i in range(len(layers))]
+    if histograms is None:
+        histograms = EfficiencyHistograms(variants=list(names) + ['any'], bins=bins, maps=maps)
+    result = propagate(layers, z, eta, phi, z_track=z_track, positions=False)
+    histograms.fill(TrackBatch.fromEtaPhi(eta, phi, z_track), np.vstack([result.hits, result.nHits > 0]))
+    return histograms
+
+
+def chunk_seeds(seed, n_chunks):
+    '''
+    independent seeds for the chunks of an event stream. unlike SeedSequence.spawn this does not change the state of
+    seed, so the same seed always gives the same stream.
+    '''
+    seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return [np.random.SeedSequence(entropy=seq.entropy, spawn_key=seq.spawn_key + (i,)) for i in range(n_chunks)]
+
+
+def stream_histograms(layers, n_events, seed, chunk_size=CHUNK_SIZE, z=Z_LAYERS, eta_range=(ETA_MIN, ETA_MAX), z_track=3000., histograms=None, bins=None, cache=None):
+    '''
+    Streaming Monte Carlo: events are generated in chunks of chunk_size, propagated through the layers and added to the
+    binned counts of AcceptanceHistograms. Nothing per event is kept, so the memory does not grow with n_events.
+    The result is reproducible for a given seed and chunk_size.
+    cache is a cache.ResultCache (or True for the default one), the result is then only computed once for the same
+    Dees (see cache.dee_key) and arguments.
+    '''
+    if cache is not None:
+        if cache is True:
+            cache = ResultCache()
+        key = dee_key(layers, function='stream_histograms', n_events=n_events, seed=seed, chunk_size=chunk_size, z=z,
+                      eta_range=eta_range, z_track=z_track, bins=bins)
+        result = cache.getOrCompute(key, lambda: stream_histograms(layers, n_events, seed, chunk_size=chunk_size, z=z,
+                                                                   eta_range=eta_range, z_track=z_track, bins=bins))
+        if histograms is None:
+            return result
+        histograms += result
+        return histograms
+
+    if histograms is None:
+        histograms = AcceptanceHistograms(n_layers=len(layers), bins=bins)
+    n_chunks = -(-n_events//chunk_size)
+    for i, chunk_seed in enumerate(chunk_seeds(seed, n_chunks)):
+        eta, phi = generate_events(min(chunk_size, n_events - i*chunk_size), chunk_seed, *eta_range)
+        fill_histograms(layers, eta, phi, z=z, z_track=z_track, histograms=histograms)
+    return histograms
+
+
+def record_hits(layers, n_events, seed, path, chunk_size=CHUNK_SIZE, z=Z_LAYERS, eta_range=(ETA_MIN, ETA_MAX), z_track=3000., names=LAYERS, dtype=np.float32, histograms=None):
+    '''
+    Writes the hits of n_events tracks as a hit table to the directory path (see hits.py): event, layer, face, sensor,
+    pixel and x, y, z of every hit, and eta, phi of every event. The events are generated and propagated in chunks
+    as in stream_histograms (the same seed gives the same events), so the memory does not grow with n_events.
+    histograms are optional AcceptanceHistograms that are filled on the way.
+    returns the hits.HitTable
+    '''
+    with HitWriter(path, layers=names, dtype=dtype) as writer:
+        n_chunks = -(-n_events//chunk_size)
+        for i, chunk_seed in enumerate(chunk_seeds(seed, n_chunks)):
+            eta, phi = generate_events(min(chunk_size, n_events - i*chunk_size), chunk_seed, *eta_range)
+            result = propagate(layers, z, eta, phi, z_track=z_track, positions=False, hits=writer)
+            if histograms is not None:
+                histograms.fill(TrackBatch.fromEtaPhi(eta, phi, z_track), result.nHits)
+    return HitTable(path)
+
+
+def analytic_efficiency(layers, z=Z_LAYERS, var='eta', bins=None, z_track=3000., z_ref=None, z_scale=1000., eta_range=(ETA_MIN, ETA_MAX), min_hits=1, subdivisions=8):
+    '''
+    Efficiency (at least min_hits layers hit) vs var ('eta' or 'r') without Monte Carlo, from the exact area of the
+    active rectangles in rings.
+    The tracks are straight lines as in propagate, so the rectangles of every layer are scaled to the plane at
+    z_track, where the areas covered by at least min_hits layers are computed. Every bin is split into subdivisions
+    rings, inside a ring the tracks are taken as uniform in area, and the rings are weighted by their width in eta
+    (within eta_range), like tracks generated flat in eta.
+    returns the bin edges and the efficiency per bin
+    '''
+    if z_ref is None:
+        z_ref = z[0]
+    n_bins, low, high = dict(BINS, **(bins or {}))[var]
+    edges = np.linspace(low, high, n_bins+1)
+
+    pieces = [[], [], [], []]
+    for layer, z_layer in zip(layers, z):
+        scale = z_track/(z_track + z_scale*(z_layer-z_ref))
+        # union per layer, a track hitting two sensors of a layer is one hit
+        for piece, corners in zip(pieces, coveredRectangles(*layer.getActiveRectangles())):
+            piece.append(corners*scale)
+    covered = coveredRectangles(*[np.concatenate(p) for p in pieces], min_count=min_hits)
+
+    fine = np.linspace(low, high, n_bins*subdivisions+1)
+    if var == 'r':
+        radii = fine
+        eta = -np.log(np.tan(np.arctan(radii/z_track)/2))
+    else:
+        eta = fine
+        radii = z_track*np.tan(2*np.arctan(np.exp(-eta)))
+    order = np.argsort(radii)
+
+    area = np.zeros(len(radii))
+    area[order] = radialArea(*covered, radii[order])
+    fraction = np.abs(np.diff(area))/(np.pi*np.abs(np.diff(radii**2)))
+
+    # eta interval of every ring within eta_range
+    eta_low = np.maximum(np.minimum(eta[:-1], eta[1:]), eta_range[0])
+    eta_high = np.minimum(np.maximum(eta[:-1], eta[1:]), eta_range[1])
+    weight = np.maximum(eta_high - eta_low, 0).reshape(n_bins, subdivisions)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return edges, (fraction.reshape(n_bins, subdivisions)*weight).sum(axis=1)/weight.sum(axis=1)
+
+
+class AcceptanceEstimate(object):
+    def __init__(self, replicas, converged=False):
+        '''
+        Result of estimate_acceptance: the histograms of independent replicas of the event sample.
+        The efficiencies are the ones of the sum of all replicas, their statistical uncertainties come from the spread
+        of the replicas, which is also valid for the stratified and quasi-random samples.
+        '''
+        self.replicas = replicas
+        self.converged = converged
+        self.histograms = AcceptanceHistograms(n_layers=replicas[0].n_layers, bins=replicas[0].bins, maps=replicas[0].maps)
+        for replica in replicas:
+            self.histograms += replica
+        self.n_events = int(self.histograms.nHits.sum())
+
+    def getEfficiency(self, var=None):
+        return self.histograms.getEfficiency(var)
+
+    def getUncertainty(self, var=None):
+        '''
+        standard error of getEfficiency(var), nan for bins without events
+        '''
+        efficiencies = np.array([replica.getEfficiency(var) for replica in self.replicas])
+        return np.std(efficiencies, axis=0, ddof=1)/np.sqrt(len(self.replicas))
+
+    def getPrecision(self, var=None):
+        '''
+        largest uncertainty of the bins of var that have events (inf if a replica has no events in one of them yet)
+        '''
+        uncertainty = np.atleast_1d(self.getUncertainty(var))
+        if var is not None:
+            uncertainty = uncertainty[self.histograms.den[var] > 0]
+        if len(uncertainty) == 0:
+            return 0.
+        return np.inf if np.isnan(uncertainty).any() else uncertainty.max()
+
+
+def estimate_acceptance(layers, precision=0.005, variables=('eta',), method='halton', n_replicas=8, batch_size=2**12, max_events=int(1e7), seed=0, z=Z_LAYERS, eta_range=(ETA_MIN, ETA_MAX), z_track=3000., bins=None, verbose=False):
+    '''
+    Estimates the acceptance until the uncertainty of the efficiency is below precision in every bin of variables
+    ('eta', 'r', 'phi', or None for the overall efficiency), or max_events were propagated.
+    The events are generated with method (see generate_events) in n_replicas independent replicas, every round adds
+    batch_size events to every replica. The result is reproducible for a given seed.
+    returns an AcceptanceEstimate
+    '''
+    replica_seeds = chunk_seeds(seed, n_replicas)
+    replicas = [AcceptanceHistograms(n_layers=len(layers), bins=bins) for _ in range(n_replicas)]
+
+    n_rounds = max(max_events//(n_replicas*batch_size), 1)
+    for k in range(n_rounds):
+        for replica, replica_seed in zip(replicas, replica_seeds):
+            if method == 'halton':
+                # the same shift of the sequence in every round, the sequence continues
+                eta, phi = generate_events(batch_size, replica_seed, *eta_range, method=method, start=k*batch_size)
+            else:
+                eta, phi = generate_events(batch_size, chunk_seeds(replica_seed, k+1)[k], *eta_range, method=method)
+            fill_histograms(layers, eta, phi, z=z, z_track=z_track, histograms=replica)
+
+        estimate = AcceptanceEstimate(replicas)
+        worst = max(estimate.getPrecision(var) for var in variables)
+        if verbose:
+            print("%d events, largest uncertainty %.4f" % (estimate.n_events, worst))
+        if worst <= precision:
+            estimate.converged = True
+            break
+
+    return estimate
+
+
+class TrackGrid(object):
+    def __init__(self, x, y, cell_size=50., extent=1200.):
+        '''
+        Tracks (positions x, y on one layer) sorted into square cells, so the tracks inside a rectangle can be found
+        without looking at all of them. Tracks outside the extent are kept in the border cells.
+        '''
+        self.x = x
+        self.y = y
+        self.cell_size = cell_size
+        self.extent = extent
+        self.n_cells = int(np.ceil(2*extent/cell_size))
+
+        ix = self.getCell(x)
+        iy = self.getCell(y)
+        cells = iy*self.n_cells + ix
+        self.order = np.argsort(cells, kind='stable').astype(np.int32)
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.n_cells**2 + 1))
+
+    def getCell(self, v):
+        return np.clip(np.floor((np.asarray(v) + self.extent)/self.cell_size).astype(np.int64), 0, self.n_cells-1)
+
+    def inside(self, x1, x2, y1, y2):
+        '''
+        indices of the tracks strictly inside any of the rectangles x1 < x < x2, y1 < y < y2 (arrays of corners)
+        '''
+        candidates = []
+        ix1, ix2 = self.getCell(np.min(x1)), self.getCell(np.max(x2))
+        for iy in range(self.getCell(np.min(y1)), self.getCell(np.max(y2))+1):
+            candidates.append(self.order[self.starts[iy*self.n_cells + ix1]:self.starts[iy*self.n_cells + ix2 + 1]])
+        candidates = np.concatenate(candidates)
+
+        x = self.x[candidates][:, np.newaxis]
+        y = self.y[candidates][:, np.newaxis]
+        inside = ((x1 < x) & (x < x2) & (y1 < y) & (y < y2)).any(axis=1)
+        return np.sort(candidates[inside])
+
+
+class AcceptanceSession(object):
+    def __init__(self, modules=None, n_events=int(1e5), seed=0, z=Z_LAYERS, z_track=3000., eta_range=(ETA_MIN, ETA_MAX), sensor=None, module=None, bins=None, cell_size=50.):
+        '''
+        Acceptance of a layout that changes by single modules, over one fixed sample of n_events tracks.
+        Every module keeps the list of tracks it covers, so add_module / remove_module only update the number of hits
+        and the histograms of those tracks.
+        modules is an optional list of module centers per layer to start with.
+        A module is made of the sensors given by layout.sensor_centers(center, **module) (2x2 sensors of the new layouts
+        if module is None), module=False makes every center a single sensor (e.g. for the TDR databases).
+        '''
+        self.sensor = Sensor2(21.4, 21.6) if sensor is None else sensor
+        self.module = {} if module is None else module
+        self.n_layers = len(z)
+        self.n_events = n_events
+
+        eta, phi = generate_events(n_events, seed, *eta_range)
+        xs, ys = layerPositions(z, eta, phi, z_track=z_track)
+        self.grids = [TrackGrid(x, y, cell_size=cell_size) for x, y in zip(xs, ys)]
+
+        # number of sensors of every layer that cover a track
+        self.coverage = np.zeros((self.n_layers, n_events), dtype=np.int16)
+        self.nHits = np.zeros(n_events, dtype=np.int16)
+
+        # the histograms start with no hits, then the numerators are updated track by track
+        self.histograms = AcceptanceHistograms(n_layers=self.n_layers, bins=bins)
+        tracks = TrackBatch.fromEtaPhi(eta, phi, z_track)
+        self.bin_index = self.histograms.getBinIndex(tracks)
+        self.histograms.fill(tracks, self.nHits, index=self.bin_index)
+
+        self.modules = {}
+        self._next_id = 0
+        if modules is not None:
+            for layer, centers in enumerate(modules):
+                for x, y in np.asarray(centers, dtype=float).reshape(-1, 2).tolist():
+                    self.add_module(layer, x, y)
+
+    def getSensors(self, x, y):
+        centers = np.array([[x, y]]) if self.module is False else sensor_centers([(x, y)], **self.module)
+        return self.sensor.getActiveAreaAt(centers[:, 0], centers[:, 1])
+
+    def update(self, tracks, change):
+        '''
+        changes the number of hits of tracks by change (+1 or -1) and updates the histograms
+        '''
+        old = self.nHits[tracks]
+        new = old + change
+        n_bins = self.n_layers + 1
+        self.histograms.nHits += np.bincount(new, minlength=n_bins) - np.bincount(old, minlength=n_bins)
+
+        # tracks that go from 0 to 1 hit or back change the numerators
+        changed = tracks[(old == 0) | (new == 0)]
+        if len(changed):
+            for name, index in self.bin_index.items():
+                index = index[changed]
+                index = index[index >= 0]
+                # a view of the numerator of the only variant, flat for the 2D maps
+                num = self.histograms.num[name][0].reshape(-1)
+                num += change*np.bincount(index, minlength=len(num))
+
+        self.nHits[tracks] = new
+
+    def add_module(self, layer, x, y):
+        '''
+        adds a module centered at x, y to a layer, returns its id
+        '''
+        tracks = self.grids[layer].inside(*self.getSensors(x, y))
+        coverage = self.coverage[layer]
+        coverage[tracks] += 1
+        self.update(tracks[coverage[tracks] == 1], +1)
+
+        module_id = self._next_id
+        self._next_id += 1
+        self.modules[module_id] = (layer, x, y, tracks)
+        return module_id
+
+    def remove_module(self, module_id):
+        layer, x, y, tracks = self.modules.pop(module_id)
+        coverage = self.coverage[layer]
+        coverage[tracks] -= 1
+        self.update(tracks[coverage[tracks] == 0], -1)
+
+    def findModule(self, layer, x, y):
+        '''
+        id of the module of a layer centered at x, y (e.g. from a list of removed modules), None if there is none
+        '''
+        for module_id, (l, mx, my, tracks) in self.modules.items():
+            if l == layer and mx == x and my == y:
+                return module_id
+        return None
+
+    def getEfficiency(self, var=None):
+        return self.histograms.getEfficiency(var)
+
+    def getFractions(self):
+        return self.histograms.getFractions()
@@ -0,0 +1,294 @@
+'''
+Benchmarks of the geometry and acceptance hot paths, on the layout databases in this repository.
+
+    python bench.py                              # run everything, write bench_results.json
+    python bench.py --quick --select populate    # a smaller set, only the benchmarks with populate in the name
+    python bench.py --save-baseline baseline.json
+    python bench.py --compare baseline.json      # exits with 1 if something got slower than --threshold
+
+Every benchmark is run --repeat times (the setup is not timed), the minimum and median time are recorded.
+The peak memory is measured with tracemalloc in one extra run, so it does not slow down the timed runs.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import partition
+from ETL import Sensor, Sensor2, Module, ReadoutBoard, SuperModule, Dee, layerPositions, propagate
+from acceptance import LAYERS, Z_LAYERS, generate_events, stream_histograms
+from layout import load_layout
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the sensors of the old (layouts) and new (new_layouts, new_yamls_configs) databases
+SENSORS = {
+    'layouts': lambda: Sensor(42.5, 22),
+    'new_layouts': lambda: Sensor2(21.4, 21.6),
+    'new_yamls_configs': lambda: Sensor2(21.4, 21.6),
+}
+
+FLAVORS = [[3, 6, 7], [6, 11, 14], [3, 6, 7, 11], [3, 6, 7, 11, 12, 14]]
+PIXELS = [(1, 1), (2, 2), (4, 4), (8, 8)]
+EVENTS = [int(1e4), int(1e5), int(1e6)]
+
+
+class Benchmark(object):
+    def __init__(self, name, params, run, setup=None):
+        '''
+        run(state) is timed, state is what setup() returns (None without setup). setup is called before every run.
+        '''
+        self.name = name
+        self.params = params
+        self.run = run
+        self.setup = setup
+
+    def getKey(self):
+        return '%s %s' % (self.name, json.dumps(self.params, sort_keys=True))
+
+    def measure(self, repeat=3, memory=True):
+        times = []
+        for _ in range(repeat):
+            state = self.setup() if self.setup is not None else None
+            start = time.perf_counter()
+            self.run(state)
+            times.append(time.perf_counter() - start)
+
+        result = dict(name=self.name, params=self.params, key=self.getKey(), repeat=repeat,
+                      time_min=min(times), time_median=float(np.median(times)))
+
+        if memory:
+            state = self.setup() if self.setup is not None else None
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            self.run(state)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1] - before
+            tracemalloc.stop()
+
+        return result
+
+
+def database_path(directory, name):
+    return os.path.join(HERE, directory, name)
+
+
+def database_files(quick=False):
+    '''
+    (directory, file name) of the databases used for the layout size benchmarks
+    '''
+    files = []
+    for directory in SENSORS:
+        names = sorted(n for n in os.listdir(os.path.join(HERE, directory)) if not n.startswith('.'))
+        files += [(directory, n) for n in names[:1 if quick else 3]]
+    return files
+
+
+def layer_centers(directory, name, cache_dir):
+    disks = list(load_layout(database_path(directory, name), cache_dir=cache_dir).values())[0]
+    return [np.asarray(disks[disk][face]) for disk, face in LAYERS]
+
+
+def supermodule(n_sensor_x=2):
+    '''
+    the supermodule of geometric_acceptance.ipynb
+    '''
+    sensor_x = 21.75
+    s = Sensor(sensor_x, 22, deadspace=0.5)
+    m = Module(0.6 + 2*sensor_x + 0.1, 56.5, n_sensor_x=n_sensor_x, n_sensor_y=2, sensor_distance_y=22.1, sensor_distance_x=sensor_x+0.1)
+    m.populate(s)
+    rb = ReadoutBoard(10, 56.5, color='green')
+    pb = ReadoutBoard(10, 29.5, color='red')
+    return SuperModule(m, pb, rb, n_modules=3, module_gap=0.5, orientation='above')
+
+
+def benchmarks(quick=False, cache_dir=None):
+    '''
+    all benchmarks, quick=True leaves out the largest sizes
+    '''
+    sm = supermodule()
+    events = EVENTS[:2] if quick else EVENTS
+    pixels = PIXELS[:3] if quick else PIXELS
+    flavors = FLAVORS[:2] if quick else FLAVORS
+    new = ('new_layouts', 'database_new_filled.yaml')
+    sensor = SENSORS[new[0]]()
+    centers = layer_centers(*new, cache_dir=cache_dir)
+
+    # loading the databases, from the yaml (cold) and from the cache (warm)
+    for directory, name in database_files(quick):
+        path = database_path(directory, name)
+        params = dict(database='%s/%s' % (directory, name))
+
+        def load_cold(tmp, path=path):
+            load_layout(path, cache_dir=tmp)
+            shutil.rmtree(tmp)
+
+        yield Benchmark('load_layout cold', params, load_cold, setup=tempfile.mkdtemp)
+        yield Benchmark('load_layout warm', params, lambda state, path=path: load_layout(path, cache_dir=cache_dir),
+                        setup=lambda path=path: load_layout(path, cache_dir=cache_dir))
+
+    # layout size
+    for directory, name in database_files(quick):
+        layer = layer_centers(directory, name, cache_dir)[0]
+        params = dict(database='%s/%s' % (directory, name), n_sensors=len(layer))
+        for materialize in (True, False):
+            yield Benchmark('Dee.fromCenters', dict(params, materialize=materialize),
+                            lambda state, layer=layer, s=SENSORS[directory](), materialize=materialize:
+                            Dee(315, 1185).fromCenters(layer, s, materialize=materialize))
+
+    # pixel granularity
+    for m, n in pixels:
+        for materialize in (True, False):
+            if materialize and m*n > 16 and quick:
+                continue
+            params = dict(m=m, n=n, materialize=materialize, n_sensors=len(centers[0]))
+            yield Benchmark('Dee.fromCenters2', params,
+                            lambda state, m=m, n=n, materialize=materialize:
+                            Dee(315, 1185).fromCenters2(centers[0], sensor, m, n, 0.1, materialize=materialize))
+
+    def populated(materialize=False):
+        dee = Dee(315, 1185)
+        dee.populate(sm, center_RB=True, materialize=materialize)
+        return dee
+
+    for m, n in pixels:
+        for materialize in (True, False):
+            yield Benchmark('Dee.getAllCorners2', dict(m=m, n=n, materialize=materialize),
+                            lambda dee, m=m, n=n, materialize=materialize: dee.getAllCorners2(m, n, 0.1, materialize=materialize),
+                            setup=populated)
+
+    # flavor count
+    for flav in flavors:
+        for materialize in (True, False):
+            yield Benchmark('Dee.populate', dict(flavors=flav, materialize=materialize),
+                            lambda state, flav=flav, materialize=materialize:
+                            Dee(315, 1185).populate(sm, flavors=flav, center_RB=True, materialize=materialize))
+
+    for n_flavors in range(2, 7):
+        flav = [3, 6, 7, 11, 12, 14][:n_flavors]
+        yield Benchmark('partition.getPartition', dict(flavors=flav, lengths=60),
+                        lambda state, flav=flav: [partition.getPartition(length, flavors=flav) for length in range(1, 61)],
+                        setup=partition.solve.cache_clear)
+
+    # hit tests, number of events
+    dee = Dee(315, 1185)
+    dee.fromCenters(centers[0], sensor)
+    dee.getIndex()
+    for n_events in events:
+        eta, phi = generate_events(n_events, 0)
+        (x,), (y,) = layerPositions([Z_LAYERS[0]], eta, phi)
+        if n_events <= int(1e4):
+            yield Benchmark('Dee.intersect', dict(n_events=n_events),
+                            lambda state, x=x.tolist(), y=y.tolist(): [dee.intersect(u, v) for u, v in zip(x, y)])
+        yield Benchmark('Dee.intersect_many', dict(n_events=n_events), lambda state, x=x, y=y: dee.intersect_many(x, y))
+
+    # event loop through the four layers
+    layers = []
+    for c in centers:
+        d = Dee(315, 1185)
+        d.fromCenters(c, sensor, materialize=False)
+        layers.append(d)
+    for n_events in events:
+        eta, phi = generate_events(n_events, 0)
+        yield Benchmark('propagate', dict(n_events=n_events),
+                        lambda state, eta=eta, phi=phi: propagate(layers, Z_LAYERS, eta, phi, positions=False))
+        yield Benchmark('stream_histograms', dict(n_events=n_events),
+                        lambda state, n_events=n_events: stream_histograms(layers, n_events, 0))
+
+
+def run(quick=False, select=None, repeat=3, memory=True, verbose=True):
+    '''
+    runs the benchmarks (select: only the ones with this in the name) and returns the results as a dict
+    '''
+    cache_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for bench in benchmarks(quick=quick, cache_dir=cache_dir):
+            if select is not None and select not in bench.name:
+                continue
+            result = bench.measure(repeat=repeat, memory=memory)
+            results.append(result)
+            if verbose:
+                print("%-70s %10.4f s %10s" % (result['key'][:70], result['time_min'],
+                                               '%.1f MB' % (result['peak_memory']/1e6) if memory else ''))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    return dict(
+        meta=dict(
+            date=datetime.datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            machine=platform.machine(),
+            processor=platform.processor(),
+            cpu_count=os.cpu_count(),
+            quick=quick,
+            repeat=repeat,
+        ),
+        results=results,
+    )
+
+
+def compare(results, baseline, threshold=1.2, min_time=1e-3):
+    '''
+    ratios of the minimum times to the ones of the baseline (matched by name and parameters).
+    returns a list of (key, baseline time, time, ratio) and the keys that are slower than threshold,
+    benchmarks faster than min_time (in s) are too noisy to count as slower
+    '''
+    base = {r['key']: r for r in baseline['results']}
+    rows = []
+    slower = []
+    for r in results['results']:
+        if r['key'] not in base:
+            continue
+        old = base[r['key']]['time_min']
+        ratio = r['time_min']/old if old > 0 else float('inf')
+        rows.append((r['key'], old, r['time_min'], ratio))
+        if ratio > threshold and r['time_min'] > min_time:
+            slower.append(r['key'])
+    return rows, slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the geometry and acceptance code')
+    parser.add_argument('--quick', action='store_true', help='leave out the largest sizes')
+    parser.add_argument('--select', default=None, help='only run the benchmarks with this in the name')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='do not measure the peak memory')
+    parser.add_argument('--output', default='bench_results.json', help='results file')
+    parser.add_argument('--save-baseline', default=None, help='also write the results to this baseline file')
+    parser.add_argument('--compare', default=None, help='baseline file to compare to')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio to the baseline time that counts as slower')
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick, select=args.select, repeat=args.repeat, memory=not args.no_memory)
+
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, slower = compare(results, baseline, threshold=args.threshold)
+        print()
+        for key, old, new, ratio in rows:
+            print("%-70s %10.4f s %10.4f s %6.2fx%s" % (key[:70], old, new, ratio, '  SLOWER' if key in slower else ''))
+        if slower:
+            print("%d of %d benchmarks are more than %.2fx slower than the baseline" % (len(slower), len(rows), args.threshold))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
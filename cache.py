@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+# the results are stored here, one <key>.pkl per result
+CACHE_DIR = os.environ.get('ETL_RESULT_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.result_cache'))
+# the least recently used results are removed when the cache gets larger than this (in bytes)
+MAX_SIZE = int(os.environ.get('ETL_RESULT_CACHE_SIZE', 2**28))
+# part of every key, increase it when the same inputs start giving different results
+VERSION = 2
+
+
+def _plain(value):
+    if isinstance(value, np.random.SeedSequence):
+        return dict(entropy=value.entropy, spawn_key=list(value.spawn_key))
+    if isinstance(value, type):
+        return value.__name__
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def make_key(arrays=(), **params):
+    '''
+    sha1 of the content of the arrays and the parameters (anything json can write, numpy values and SeedSequences)
+    '''
+    sha = hashlib.sha1()
+    sha.update(json.dumps(dict(params, version=VERSION), sort_keys=True, default=_plain).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+def sensor_params(sensor):
+    '''
+    what defines the active area of a Sensor/Sensor2: the type, the dimensions and the deadspace
+    '''
+    params = dict(type=type(sensor).__name__, height=sensor.height, width=sensor.width)
+    for name in ('deadspace', 'deadspace1', 'deadspace2'):
+        if hasattr(sensor, name):
+            params[name] = getattr(sensor, name)
+    return params
+
+
+def layout_key(centers, sensor, pixels=None, **params):
+    '''
+    key of a result for the sensor centers of every layer (see sweep.load_database), the sensor and the pixels
+    (m, n, gap) if any. params are the other inputs, e.g. z, eta_range, seed and n_events.
+    '''
+    return make_key(centers, sensor=sensor_params(sensor), pixels=pixels, **params)
+
+
+def dee_key(layers, **params):
+    '''
+    key of a result for Dees, from the rectangles they are hit tested with (vax1, vax2, vay1, vay2 and the pixels,
+    see Dee.setPixels), so it works for Dees built in any way
+    '''
+    arrays = []
+    pixels = []
+    for dee in layers:
+        arrays += [dee.vax1, dee.vax2, dee.vay1, dee.vay2]
+        pixels.append(None if dee.pixel_grid is None else list(dee.pixel_grid))
+    return make_key(arrays, pixels=pixels, **params)
+
+
+class ResultCache(object):
+    def __init__(self, directory=None, max_size=None):
+        '''
+        Content addressed cache of results on disk, keyed by make_key/layout_key/dee_key.
+        Reading a result marks it as used, when the cache is larger than max_size bytes the least recently used
+        results are removed.
+        '''
+        self.directory = CACHE_DIR if directory is None else directory
+        self.max_size = MAX_SIZE if max_size is None else max_size
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key, default=None):
+        path = self.getPath(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first, so that a concurrent reader never sees half a result
+        tmp = os.path.join(self.directory, '.%s.%d' % (key, os.getpid()))
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.getPath(key))
+        self.evict()
+
+    def __contains__(self, key):
+        return os.path.isfile(self.getPath(key))
+
+    def getOrCompute(self, key, compute):
+        '''
+        the cached result for key, or compute() which is then stored
+        '''
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def entries(self):
+        '''
+        (last used, size, path) of all results, the least recently used first
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl') or name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def getSize(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,207 @@
+'''
+Columnar hit records: one row per layer hit by a track, replacing face_dict/traject_dict/angles_dict of
+different configurations.ipynb.
+
+    from hits import HitTable
+    record_hits(layers, int(1e7), seed=0, path='hits_config_2')    # see acceptance.record_hits
+    table = HitTable('hits_config_2')
+    four = table.getEvents(4)                                     # events with a hit on all four layers
+    rows = table.getEventRows(four)
+    table.x[rows], table.y[rows], table.eta[four]
+
+The table is a directory with one raw binary file per column and meta.json. The rows are written in chunks as the
+events are propagated, so the memory does not grow with the number of events, and read back as memory maps.
+The rows are sorted by event and layer.
+'''
+import json
+import os
+
+import numpy as np
+
+import instrument
+
+
+# columns of the rows (one per hit) and their types, x/y/z use the dtype of the HitWriter
+COLUMNS = [('event', np.int64), ('layer', np.int8), ('face', np.int8), ('sensor', np.int32), ('pixel', np.int32),
+           ('x', None), ('y', None), ('z', None)]
+# columns of the events (one per track)
+EVENT_COLUMNS = ['eta', 'phi']
+# codes of the face column
+FACES = ['front', 'back']
+# rows that are buffered before they are written
+CHUNK_ROWS = 2**20
+
+
+class HitWriter(object):
+    def __init__(self, path, layers=None, dtype=np.float32, chunk_rows=CHUNK_ROWS, events=True):
+        '''
+        Writes a hit table to the directory path (see HitTable), for propagate(..., hits=writer).
+        layers are the names of the layers, e.g. acceptance.LAYERS, the face column is then the index of their face in
+        FACES (-1 without names). dtype of the positions, float32 is good to ~0.1 mm at the size of the Dees.
+        events=True also writes eta and phi of every track.
+        Use it as a context manager or call close, the table can only be read once it is closed.
+        '''
+        self.path = path
+        self.layers = None if layers is None else [list(layer) if isinstance(layer, (list, tuple)) else [layer] for layer in layers]
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.events = events
+        self.n_rows = 0
+        self.n_events = 0
+        self.dtypes = {name: np.dtype(t if t is not None else dtype) for name, t in COLUMNS}
+        if events:
+            self.dtypes.update({name: np.dtype(np.float64) for name in EVENT_COLUMNS})
+
+        os.makedirs(path, exist_ok=True)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.exists(meta):
+            os.remove(meta)
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name in self.dtypes}
+        self.buffer = {name: [] for name in self.dtypes}
+        self.buffered = 0
+
+    def getFace(self, layer):
+        if self.layers is None or layer >= len(self.layers) or self.layers[layer][-1] not in FACES:
+            return -1
+        return FACES.index(self.layers[layer][-1])
+
+    def writeChunk(self, hits, index, xs, ys, z, pixels=None, eta=None, phi=None):
+        '''
+        adds the next len(hits[0]) events: hits (n_layers, n) masks, index the sensor or pixel that was hit
+        (see Dee.intersect_many), xs/ys the positions and z the position of every layer (in mm).
+        pixels is the number of pixels per sensor of every layer (0 without pixels), the index is then split into the
+        sensor and the pixel in the sensor
+        '''
+        with instrument.stage('write_hits'):
+            n_layers, n = hits.shape
+            # event major, so the rows come out sorted by event and layer
+            event, layer = np.nonzero(hits.T)
+            sensor = index[layer, event]
+            pixel = np.full(len(event), -1, dtype=np.int64)
+            if pixels is not None:
+                per_sensor = np.asarray(pixels, dtype=np.int64)[layer]
+                on_pixels = per_sensor > 0
+                pixel[on_pixels] = sensor[on_pixels] % per_sensor[on_pixels]
+                sensor = np.where(on_pixels, sensor//np.maximum(per_sensor, 1), sensor)
+
+            faces = np.array([self.getFace(i) for i in range(n_layers)], dtype=np.int8)
+            columns = dict(
+                event=event + self.n_events,
+                layer=layer,
+                face=faces[layer],
+                sensor=sensor,
+                pixel=pixel,
+                x=xs[layer, event],
+                y=ys[layer, event],
+                z=np.asarray(z, dtype=float)[layer],
+            )
+            if self.events:
+                if eta is None or phi is None:
+                    raise ValueError('the writer stores the tracks (events=True), eta and phi are needed')
+                columns['eta'] = eta
+                columns['phi'] = phi
+            for name, values in columns.items():
+                self.buffer[name].append(np.asarray(values, dtype=self.dtypes[name]))
+
+            self.n_events += n
+            self.n_rows += len(event)
+            self.buffered += len(event)
+            if self.buffered >= self.chunk_rows:
+                self.flush()
+
+    def flush(self):
+        for name, arrays in self.buffer.items():
+            for array in arrays:
+                self.files[name].write(array.tobytes())
+            del arrays[:]
+        self.buffered = 0
+
+    def close(self):
+        if not self.files:
+            return
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        meta = dict(
+            n_rows=self.n_rows,
+            n_events=self.n_events,
+            layers=self.layers,
+            faces=FACES,
+            dtypes={name: dtype.str for name, dtype in self.dtypes.items()},
+        )
+        # meta.json is written last, a table without it is incomplete
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HitTable(object):
+    def __init__(self, path):
+        '''
+        Reads a hit table written by HitWriter, every column is a read only memory map (attributes event, layer, face,
+        sensor, pixel, x, y, z with one entry per hit, eta and phi with one entry per event), so tables larger than
+        the memory can be queried.
+        '''
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.n_rows = self.meta['n_rows']
+        self.n_events = self.meta['n_events']
+        self.layers = self.meta['layers']
+        self.columns = list(self.meta['dtypes'])
+        for name, dtype in self.meta['dtypes'].items():
+            size = self.n_events if name in EVENT_COLUMNS else self.n_rows
+            if size == 0:
+                # empty files can not be memory mapped
+                setattr(self, name, np.zeros(0, dtype=dtype))
+            else:
+                setattr(self, name, np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=(size,)))
+
+    def __len__(self):
+        return self.n_rows
+
+    def getHitCounts(self):
+        '''
+        number of layers hit by every event
+        '''
+        return np.bincount(self.event, minlength=self.n_events)
+
+    def getEvents(self, n_hits=None, layers=None):
+        '''
+        the events with n_hits hits (e.g. 4 or 0), or with a hit on all of layers (indices)
+        '''
+        if layers is not None:
+            hit = np.ones(self.n_events, dtype=bool)
+            for layer in layers:
+                hit &= np.bincount(self.event[self.layer == layer], minlength=self.n_events) > 0
+            return np.nonzero(hit)[0]
+        return np.nonzero(self.getHitCounts() == n_hits)[0]
+
+    def getEventRows(self, events):
+        '''
+        indices of the rows (hits) of the events, which have to be sorted (as the results of getEvents)
+        '''
+        events = np.asarray(events, dtype=np.int64)
+        start = np.searchsorted(self.event, events, side='left')
+        stop = np.searchsorted(self.event, events, side='right')
+        lengths = stop - start
+        # the ranges start ... stop of all events concatenated
+        offsets = np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def getColumns(self, rows=None):
+        '''
+        the hit columns as name -> array, all rows or the given ones
+        '''
+        return {name: np.asarray(getattr(self, name) if rows is None else getattr(self, name)[rows])
+                for name in self.columns if name not in EVENT_COLUMNS}
+
+    def toPandas(self, rows=None):
+        import pandas as pd
+        return pd.DataFrame(self.getColumns(rows))
@@ -0,0 +1,206 @@
+'''
+Opt-in instrumentation of the simulation pipeline.
+
+    import instrument
+    with instrument.recording(memory=True):
+        run_sweep(load_configurations('new_yamls_configs'), n_events=int(1e6))
+    print(instrument.report())
+    instrument.dump('profile.json')
+
+The stages (loading the layouts, building the Dees, the pixels, generating events, propagating, hit testing and
+filling the histograms) record their number of calls and wall time (including the stages called inside them),
+and with memory=True the peak memory allocated in them (with tracemalloc, which makes everything slower).
+The hit tests also count the points that were looked up and the rectangles that were tested for them.
+When the instrumentation is off (the default) a stage only costs checking ENABLED.
+'''
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+ENABLED = False
+MEMORY = False
+
+# name -> [calls, total time, maximum time, peak memory]
+_stages = {}
+# name -> count
+_counters = {}
+# [name, start time, memory at the start, peak memory] of the running stages
+_stack = []
+
+
+def enable(memory=False):
+    global ENABLED, MEMORY
+    ENABLED = True
+    MEMORY = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global ENABLED, MEMORY
+    if MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    ENABLED = False
+    MEMORY = False
+
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+    del _stack[:]
+
+
+def _start(name):
+    current = 0
+    if MEMORY:
+        current, peak = tracemalloc.get_traced_memory()
+        if _stack:
+            _stack[-1][3] = max(_stack[-1][3], peak)
+        tracemalloc.reset_peak()
+    _stack.append([name, time.perf_counter(), current, current])
+
+
+def _stop():
+    name, start, current, peak = _stack.pop()
+    elapsed = time.perf_counter() - start
+    if MEMORY:
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if _stack:
+            _stack[-1][3] = max(_stack[-1][3], peak)
+        tracemalloc.reset_peak()
+    stats = _stages.setdefault(name, [0, 0., 0., 0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    stats[3] = max(stats[3], peak - current)
+
+
+class _Stage(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _start(self.name)
+
+    def __exit__(self, *args):
+        _stop()
+
+
+class _Off(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_off = _Off()
+
+
+def stage(name):
+    '''
+    context manager that records a stage, e.g. with instrument.stage('propagate'): ...
+    '''
+    return _Stage(name) if ENABLED else _off
+
+
+def timed(name):
+    '''
+    decorator that records every call of a function as the stage name
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            _start(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _stop()
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    '''
+    adds n to a counter. callers check ENABLED first if n is expensive to compute
+    '''
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + int(n)
+
+
+@contextmanager
+def recording(memory=False, clear=True):
+    '''
+    enables the instrumentation inside a with block (and resets what was recorded before, unless clear=False)
+    '''
+    if clear:
+        reset()
+    was_enabled, had_memory = ENABLED, MEMORY
+    enable(memory=memory)
+    try:
+        yield
+    finally:
+        disable()
+        if was_enabled:
+            enable(memory=had_memory)
+
+
+def getStats():
+    '''
+    what was recorded as a dict:
+    stages: name -> calls, time, mean_time, max_time (in s) and peak_memory (in bytes, with memory=True)
+    counters: name -> count
+    '''
+    stages = {}
+    for name, (calls, total, longest, peak) in _stages.items():
+        stages[name] = dict(calls=calls, time=total, mean_time=total/calls, max_time=longest)
+        if peak:
+            stages[name]['peak_memory'] = peak
+    return dict(stages=stages, counters=dict(_counters))
+
+
+def merge(stats):
+    '''
+    adds what was recorded somewhere else (the getStats of a worker process)
+    '''
+    for name, s in stats['stages'].items():
+        mine = _stages.setdefault(name, [0, 0., 0., 0])
+        mine[0] += s['calls']
+        mine[1] += s['time']
+        mine[2] = max(mine[2], s['max_time'])
+        mine[3] = max(mine[3], s.get('peak_memory', 0))
+    for name, n in stats['counters'].items():
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def dump(path):
+    with open(path, 'w') as f:
+        json.dump(getStats(), f, indent=1)
+
+
+def report():
+    '''
+    the stages (longest first) and counters as a table
+    '''
+    stats = getStats()
+    lines = ["%-24s %8s %12s %12s %12s" % ('stage', 'calls', 'time [s]', 'mean [ms]', 'peak [MB]')]
+    for name, s in sorted(stats['stages'].items(), key=lambda item: -item[1]['time']):
+        lines.append("%-24s %8d %12.4f %12.4f %12s" % (name, s['calls'], s['time'], 1e3*s['mean_time'],
+                                                        '%.1f' % (s['peak_memory']/1e6) if 'peak_memory' in s else ''))
+    for name, n in sorted(stats['counters'].items()):
+        lines.append("%-24s %8d" % (name, n))
+    counters = stats['counters']
+    if counters.get('hit_test.points'):
+        lines.append("rectangles tested per lookup: %.3f (of %.1f)" % (
+            counters['hit_test.rectangles_tested']/counters['hit_test.points'],
+            counters['hit_test.rectangles']/counters['hit_test.points']))
+    return '\n'.join(lines)
@@ -0,0 +1,532 @@
+import hashlib
+import json
+import math
+import os
+import re
+
+import numpy as np
+from yaml import load, dump
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+import instrument
+
+
+# dimensions of the modules and sensors of the new layouts (realistic_layout_export.ipynb)
+MODULE_X = 43.1
+MODULE_Y = 56.5
+SENSOR_X = 21.4
+SENSOR_Y = 21.6
+SENSOR_GAP = 0.25
+
+# the faces of a configuration, in the order of export_layout
+FACES = [('disk1', 'front'), ('disk1', 'back'), ('disk2', 'front'), ('disk2', 'back')]
+
+# the module center files of a configuration in new_configs are <FRONT><suffix> and <BACK><suffix>
+FRONT = 'Face 1 and 3'
+BACK = 'Face 2 and 4'
+
+# database_new_config_<N> of new_yamls_configs: the suffix of the module center files in new_configs and the sensor
+# dimensions it was exported with (the default ones if not given, only the pitch sensor + SENSOR_GAP matters)
+CONFIGS = {
+    1: ('', {}),
+    2: ('', dict(sensor_x=22.55, sensor_y=22.75)),
+    3: ('_2', {}),
+    4: ('_4', {}),
+    5: ('_4', dict(sensor_x=23.3, sensor_y=23.5)),
+    6: ('_6', {}),
+}
+
+# the converted databases are stored here, one <content hash>.npy / .json pair per database
+CACHE_DIR = os.environ.get('ETL_LAYOUT_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.layout_cache'))
+
+# (path, mtime, size) -> content hash, so unchanged files are only hashed once per process
+_hashes = {}
+
+
+def file_hash(path):
+    '''
+    sha1 of the content of a file
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _hashes[key] = sha.hexdigest()
+    return _hashes[key]
+
+
+def convert_layout(database):
+    '''
+    turns a database as loaded from yaml (name -> disk -> face -> list of (x, y)) into one (N, 2) array of all the
+    centers and the table of contents [name, disk, face, start, stop]
+    '''
+    arrays = []
+    toc = []
+    start = 0
+    for name, disks in database.items():
+        for disk, faces in disks.items():
+            for face, centers in faces.items():
+                centers = np.array(centers, dtype=float).reshape(-1, 2)
+                arrays.append(centers)
+                toc.append([name, disk, face, start, start + len(centers)])
+                start += len(centers)
+    centers = np.concatenate(arrays) if arrays else np.zeros((0, 2))
+    return centers, toc
+
+
+def unpack_layout(centers, toc):
+    '''
+    inverse of convert_layout, the faces are views of centers
+    '''
+    database = {}
+    for name, disk, face, start, stop in toc:
+        database.setdefault(name, {}).setdefault(disk, {})[face] = centers[start:stop]
+    return database
+
+
+@instrument.timed('load_layout')
+def load_layout(path, cache_dir=None):
+    '''
+    Loads a layout database (e.g. new_layouts/database_new_filled.yaml) as name -> disk -> face -> (N, 2) array
+    of the sensor/module centers, which can be given to Dee.fromCenters directly.
+    The first time a database is loaded it is parsed with yaml and stored in the cache directory, keyed by the hash of
+    its content. After that the centers are memory mapped from the cache, without parsing the yaml again.
+    '''
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    digest = file_hash(path)
+    npy = os.path.join(cache_dir, digest + '.npy')
+    toc_file = os.path.join(cache_dir, digest + '.json')
+
+    if os.path.isfile(npy) and os.path.isfile(toc_file):
+        instrument.count('load_layout.cache_hits')
+        with open(toc_file) as f:
+            toc = json.load(f)
+        return unpack_layout(np.load(npy, mmap_mode='r'), toc)
+
+    with instrument.stage('yaml'), open(path) as f:
+        centers, toc = convert_layout(load(f, Loader=Loader))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to temporary files first, so that a concurrent reader never sees half a cache entry
+    tmp = '.%s.%d' % (digest, os.getpid())
+    np.save(os.path.join(cache_dir, tmp + '.npy'), centers)
+    with open(os.path.join(cache_dir, tmp + '.json'), 'w') as f:
+        json.dump(toc, f)
+    os.replace(os.path.join(cache_dir, tmp + '.npy'), npy)
+    os.replace(os.path.join(cache_dir, tmp + '.json'), toc_file)
+
+    return unpack_layout(np.load(npy, mmap_mode='r'), toc)
+
+
+def load_layouts(directory, selection=None, cache_dir=None):
+    '''
+    all layout databases in a directory (e.g. new_yamls_configs), as file name -> database.
+    selection is an optional function of the file name, e.g. lambda name: 'filtered' in name
+    '''
+    layouts = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.startswith('.') or (selection is not None and not selection(name)):
+            continue
+        layouts[name] = load_layout(path, cache_dir=cache_dir)
+    return layouts
+
+
+def make_txt2(first_mod_center, mod_size_x=MODULE_X, mod_size_y=MODULE_Y, mod_gap_x=0.5, mod_gap_y=29.2, inner_radius_dee=315, outer_radius_dee=1185):
+    '''
+    module centers of a face, as make_txt2 in generating txts.ipynb:
+    rows of modules from first_mod_center towards -x and -y, as long as the modules are on the Dee, mirrored at x = 0.
+    returns a list of (x, y)
+    '''
+    centers = []
+    x, y = first_mod_center[0], first_mod_center[1]
+    while y >= -1*outer_radius_dee:
+        # rows above the Dee have no modules (np.sqrt in the notebook gives nan there)
+        while abs(y) <= outer_radius_dee and x > -1*math.sqrt(outer_radius_dee**2 - y**2):
+            x1 = x - mod_size_x/2
+            x2 = x + mod_size_x/2
+            y1 = y - mod_size_y/2
+            y2 = y + mod_size_y/2
+            r2 = [x1*x1 + y2*y2, x2*x2 + y2*y2, x2*x2 + y1*y1, x1*x1 + y1*y1]
+
+            if min(r2) > inner_radius_dee**2 and max(r2) < outer_radius_dee**2:
+                centers.append((x, y))
+                x -= (mod_size_x + mod_gap_x)
+            elif min(r2) < inner_radius_dee**2:
+                x -= (mod_size_x + mod_gap_x)
+            else:
+                break
+
+        y -= (mod_size_y + mod_gap_y)
+        x = first_mod_center[0]
+
+    centers_all = []
+    for x, y in centers:
+        centers_all.append((x, y))
+        centers_all.append((-x, y))
+    return centers_all
+
+
+def sensor_offsets(m=2, n=2, module_x=MODULE_X, module_y=MODULE_Y, sensor_x=SENSOR_X, sensor_y=SENSOR_Y, sensor_gap=SENSOR_GAP):
+    '''
+    centers of the m x n sensors of a module w.r.t. its upper left corner, as in realistic_layout_export.ipynb
+    '''
+    deadspace_mod_x = (module_x - m*sensor_x - (m-1)*sensor_gap)/2
+    deadspace_mod_y = (module_y - n*sensor_y - (n-1)*sensor_gap)/2
+
+    coors = []
+    initial_y = -1*deadspace_mod_y - (sensor_y/2)
+    for i in range(n):
+        initial_x = deadspace_mod_x + (sensor_x/2)
+        for j in range(m):
+            coors.append((initial_x, initial_y))
+            initial_x += sensor_x + sensor_gap
+        initial_y -= sensor_y + sensor_gap
+    return np.array(coors).reshape(-1, 2)
+
+
+def sensor_centers(module_centers, m=2, n=2, module_x=MODULE_X, module_y=MODULE_Y, sensor_x=SENSOR_X, sensor_y=SENSOR_Y, sensor_gap=SENSOR_GAP):
+    '''
+    sensor centers of all modules at once, in the order of makeModule_full / fillDee in realistic_layout_export.ipynb.
+    returns an (N*m*n, 2) array
+    '''
+    module_centers = np.asarray(module_centers, dtype=float).reshape(-1, 2)
+    corners = np.stack([module_centers[:, 0] - module_x/2, module_centers[:, 1] + module_y/2], axis=1)
+    offsets = sensor_offsets(m, n, module_x, module_y, sensor_x, sensor_y, sensor_gap)
+    return (offsets[np.newaxis, :, :] + corners[:, np.newaxis, :]).reshape(-1, 2)
+
+
+def sensor_pitch(centers, m=2, n=2):
+    '''
+    distance (x, y) of the neighbouring sensors of a module, from sensor centers in the order of sensor_centers:
+    the most common step to the next sensor in the same row of a module, and to the first one of the next row
+    '''
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    dx, dy = np.round(np.diff(centers, axis=0), 6).T
+    pitch_x = pitch_y = 0.
+    if m > 1:
+        steps = dx[(dy == 0) & (dx > 0)]
+        if len(steps):
+            values, counts = np.unique(steps, return_counts=True)
+            pitch_x = values[np.argmax(counts)]
+    if n > 1:
+        steps = -dy[(dy < 0) & np.isclose(dx, -(m-1)*pitch_x)]
+        if len(steps):
+            values, counts = np.unique(steps, return_counts=True)
+            pitch_y = values[np.argmax(counts)]
+    return pitch_x, pitch_y
+
+
+def module_centers(centers, m=2, n=2, pitch=None):
+    '''
+    centers of the modules of m x n sensors that hold the sensors with the given centers, also if some sensors of a
+    module are missing (as in the filtered databases). pitch is the distance (x, y) of the neighbouring sensors of a
+    module, by default it is found from the order of the sensors (see sensor_pitch).
+    every sensor gives one candidate module center per position in the module, the candidate shared with most of the
+    other sensors is taken (the wrong ones fall between the modules). returns an (N, 2) array, N <= len(centers)
+    '''
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    if len(centers) == 0:
+        return np.zeros((0, 2))
+    pitch_x, pitch_y = sensor_pitch(centers, m, n) if pitch is None else pitch
+    column, row = np.meshgrid(np.arange(m), np.arange(n))
+    offsets = np.stack([(column.ravel() - (m-1)/2)*pitch_x, ((n-1)/2 - row.ravel())*pitch_y], axis=1)
+
+    # rounded to 0.1 um, finer than the digits of the layouts so that the rounding does not split a module
+    candidates = np.round(centers[:, np.newaxis, :] - offsets[np.newaxis, :, :], 4).reshape(-1, 2)
+    unique, inverse, votes = np.unique(candidates, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(len(centers), -1)
+    best = inverse[np.arange(len(centers)), np.argmax(votes[inverse], axis=1)]
+    return unique[np.unique(best)]
+
+
+def inside_radius(module_centers, radius, size_x=MODULE_X, size_y=MODULE_Y):
+    '''
+    mask of the modules with all four corners inside radius (as get_counts in generating txts.ipynb)
+    '''
+    module_centers = np.asarray(module_centers, dtype=float).reshape(-1, 2)
+    x, y = np.abs(module_centers[:, 0]) + size_x/2, np.abs(module_centers[:, 1]) + size_y/2
+    return x*x + y*y < radius**2
+
+
+def to_float(values):
+    '''
+    array of strings to floats at once, nan where a string is not a number (e.g. the #REF! of the face files)
+    '''
+    values = np.char.strip(np.asarray(values, dtype=str))
+    try:
+        return values.astype(float)
+    except ValueError:
+        pass
+    # only digits, signs, points and exponents left: numbers, anything else is not
+    numeric = (np.char.str_len(np.char.strip(values, '+-.0123456789eE')) == 0) & (np.char.str_len(values) > 0)
+    result = np.full(values.shape, np.nan)
+    try:
+        result[numeric] = values[numeric].astype(float)
+    except ValueError:
+        result[numeric] = [_float_or_nan(v) for v in values[numeric]]
+    return result
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def read_face(path):
+    '''
+    module centers of a face file, tab separated as in data (Module, X, Y, Z) or comma separated as in new_configs (index, X, Y).
+    rows without numeric coordinates (#REF!) are skipped. returns an (N, 2) array
+    '''
+    with open(path) as f:
+        header = f.readline()
+        lines = f.read().splitlines()
+    delimiter = '\t' if '\t' in header else ','
+    columns = [c.strip() for c in header.split(delimiter)]
+    ix, iy = columns.index('X'), columns.index('Y')
+    rows = [line.split(delimiter) for line in lines if line.strip()]
+    centers = to_float([(row[ix], row[iy]) for row in rows]).reshape(-1, 2)
+    return centers[~np.isnan(centers).any(axis=1)]
+
+
+def _yaml_float(value):
+    # as the float representer of PyYAML
+    if value != value:
+        return '.nan'
+    if value in (np.inf, -np.inf):
+        return '.inf' if value > 0 else '-.inf'
+    text = repr(value).lower()
+    if '.' not in text and 'e' in text:
+        text = text.replace('e', '.0e', 1)
+    return text
+
+
+def dump_layout(database, f):
+    '''
+    writes a database (name -> disk -> face -> (N, 2) centers) to the open file f exactly as
+    yaml.dump(database, f, Dumper=Dumper, default_flow_style=False) does with lists of (x, y) tuples, which is the format
+    of the databases in this repository, but without going through PyYAML for every number
+    '''
+    keys = [k for disks in database.values() for faces in disks.values() for k in faces] + list(database)
+    keys += [k for disks in database.values() for k in disks]
+    if not all(isinstance(k, str) and re.match(r'^[A-Za-z_][\w.-]*$', k) for k in keys):
+        # keys that need quoting
+        dump({name: {disk: {face: [tuple(c) for c in np.asarray(centers, dtype=float).reshape(-1, 2).tolist()]
+                            for face, centers in faces.items()} for disk, faces in disks.items()}
+              for name, disks in database.items()}, f, Dumper=Dumper, default_flow_style=False)
+        return
+
+    for name in sorted(database):
+        f.write('%s:\n' % name)
+        for disk in sorted(database[name]):
+            f.write('  %s:\n' % disk)
+            for face in sorted(database[name][disk]):
+                centers = np.asarray(database[name][disk][face], dtype=float).reshape(-1, 2).tolist()
+                if not centers:
+                    f.write('    %s: []\n' % face)
+                    continue
+                f.write('    %s:\n' % face)
+                f.write(''.join('    - !!python/tuple\n      - %s\n      - %s\n' % (_yaml_float(x), _yaml_float(y))
+                                for x, y in centers))
+
+
+def export_layout(faces, path=None, name='new', m=2, n=2, module_x=MODULE_X, module_y=MODULE_Y, sensor_x=SENSOR_X, sensor_y=SENSOR_Y, sensor_gap=SENSOR_GAP, plot=False):
+    '''
+    sensor centers of the four faces of a configuration, replacing fillDee / makeModule_full in realistic_layout_export.ipynb.
+    faces are the module centers of disk1 front, disk1 back, disk2 front and disk2 back (see FACES), as (N, 2) arrays or
+    face files (see read_face). every module has m x n sensors (see sensor_centers).
+    writes the database to path (if given) in the yaml format of new_yamls_configs, plot=True draws the four faces.
+    returns the database name -> disk -> face -> (N, 2) sensor centers, as load_layout
+    '''
+    module = dict(m=m, n=n, module_x=module_x, module_y=module_y, sensor_x=sensor_x, sensor_y=sensor_y, sensor_gap=sensor_gap)
+    database = {name: {}}
+    modules = []
+    for (disk, face), centers in zip(FACES, faces):
+        if isinstance(centers, str):
+            centers = read_face(centers)
+        modules.append(np.asarray(centers, dtype=float).reshape(-1, 2))
+        database[name].setdefault(disk, {})[face] = sensor_centers(modules[-1], **module)
+
+    if path is not None:
+        with open(path, 'w') as f:
+            dump_layout(database, f)
+
+    if plot:
+        import matplotlib.pyplot as plt
+        from render import draw_modules
+
+        fig, axes = plt.subplots(2, 2, figsize=(15, 15))
+        for ax, (disk, face), centers in zip(axes.ravel(), FACES, modules):
+            draw_modules(centers, database[name][disk][face], ax=ax, module_x=module_x, module_y=module_y,
+                         sensor_x=sensor_x, sensor_y=sensor_y)
+            ax.set_title('%s %s' % (disk, face))
+
+    return database
+
+
+def export_configs(directory, output=None, configs=CONFIGS, **kwargs):
+    '''
+    exports the configurations (number -> (suffix, sensor dimensions), see CONFIGS) from the module center files
+    FRONT<suffix> and BACK<suffix> in directory (the front faces of both disks are FRONT<suffix>, the back faces
+    BACK<suffix>) to output/database_new_config_<number>, which reproduces the databases in new_yamls_configs.
+    the keyword arguments are passed to export_layout. returns the file name -> database
+    '''
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+    faces = {}
+    databases = {}
+    for number, (suffix, module) in sorted(configs.items()):
+        if suffix not in faces:
+            faces[suffix] = [read_face(os.path.join(directory, name + suffix)) for name in (FRONT, BACK)]
+        front, back = faces[suffix]
+        name = 'database_new_config_%d' % number
+        path = None if output is None else os.path.join(output, name)
+        databases[name] = export_layout([front, back, front, back], path=path, **dict(module, **kwargs))
+    return databases
+
+
+class Layout(object):
+    def __init__(self, centers, size_x=MODULE_X, size_y=MODULE_Y):
+        '''
+        Modules (or sensors) of one face, given by their (N, 2) centers and size.
+        The corners x1, x2, y1, y2 and the smallest and largest distance of every rectangle from the origin (r_min, r_max)
+        are computed once, so that the radial queries are single comparisons of arrays.
+        '''
+        self.centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        self.size_x = size_x
+        self.size_y = size_y
+        x, y = self.centers[:, 0], self.centers[:, 1]
+        self.x1 = x - size_x/2
+        self.x2 = x + size_x/2
+        self.y1 = y - size_y/2
+        self.y2 = y + size_y/2
+        self.r = np.hypot(x, y)
+        # the farthest corner, and the closest point of the rectangle (0 if it covers the origin)
+        self.r_max = np.hypot(np.maximum(np.abs(self.x1), np.abs(self.x2)), np.maximum(np.abs(self.y1), np.abs(self.y2)))
+        self.r_min = np.hypot(np.maximum(np.maximum(self.x1, -self.x2), 0), np.maximum(np.maximum(self.y1, -self.y2), 0))
+
+    @classmethod
+    def fromFace(cls, path, size_x=MODULE_X, size_y=MODULE_Y):
+        '''
+        the modules of a face file, see read_face
+        '''
+        return cls(read_face(path), size_x=size_x, size_y=size_y)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def __getitem__(self, key):
+        '''
+        the modules selected by a mask, index array or slice
+        '''
+        return Layout(self.centers[key], size_x=self.size_x, size_y=self.size_y)
+
+    def inside(self, radius):
+        '''
+        mask of the modules with all four corners inside radius, see inside_radius
+        '''
+        return inside_radius(self.centers, radius, size_x=self.size_x, size_y=self.size_y)
+
+    def outside(self, radius):
+        '''
+        mask of the modules completely outside radius
+        '''
+        return self.r_min >= radius
+
+    def straddling(self, radius):
+        '''
+        mask of the modules that are crossed by the circle of radius
+        '''
+        return ~self.inside(radius) & ~self.outside(radius)
+
+    def within(self, radius):
+        '''
+        mask of the modules with the center inside radius (as filtering.ipynb)
+        '''
+        return self.r < radius
+
+    def getCounts(self, radius):
+        '''
+        number of modules inside, outside and straddling radius
+        '''
+        inside = int(self.inside(radius).sum())
+        outside = int(self.outside(radius).sum())
+        return dict(n_modules=len(self), inside=inside, outside=outside, straddling=len(self)-inside-outside)
+
+    def countAnnuli(self, edges, by='corners'):
+        '''
+        number of modules in every annulus edges[i] <= r < edges[i+1].
+        by='corners' counts the modules that are completely inside an annulus, by='center' the modules by their center
+        '''
+        edges = np.asarray(edges, dtype=float)
+        if by == 'center':
+            index = np.searchsorted(edges, self.r, side='right') - 1
+            valid = (index >= 0) & (index < len(edges)-1)
+        elif by == 'corners':
+            index = np.searchsorted(edges, self.r_min, side='right') - 1
+            valid = (index >= 0) & (index < len(edges)-1)
+            valid[valid] &= self.r_max[valid] < edges[index[valid]+1]
+        else:
+            raise ValueError("by has to be 'corners' or 'center', not %s" % by)
+        return np.bincount(index[valid], minlength=len(edges)-1)
+
+    def cut(self, radius, by='corners'):
+        '''
+        the modules inside radius, with all corners (by='corners') or the center (by='center')
+        '''
+        if by not in ('corners', 'center'):
+            raise ValueError("by has to be 'corners' or 'center', not %s" % by)
+        return self[self.inside(radius) if by == 'corners' else self.within(radius)]
+
+
+def all_counts(directory, radius=1185, size_x=MODULE_X, size_y=MODULE_Y):
+    '''
+    Layout.getCounts of all face files in a directory (as all_counts in generating txts.ipynb), as file name -> counts
+    '''
+    counts = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and not name.startswith('.'):
+            counts[name] = Layout.fromFace(path, size_x=size_x, size_y=size_y).getCounts(radius)
+    return counts
+
+
+def filter_layout(database, radius=800, faces=(('disk2', 'back'),), by='center', size_x=SENSOR_X, size_y=SENSOR_Y):
+    '''
+    the database (name -> disk -> face -> centers) with only the sensors inside radius on faces, by default the
+    filtered 800 variant of filtering.ipynb (disk2 back, sensor centers within 800 mm). the other faces are kept as they are
+    '''
+    filtered = {}
+    for name, disks in database.items():
+        filtered[name] = {}
+        for disk, disk_faces in disks.items():
+            filtered[name][disk] = {}
+            for face, centers in disk_faces.items():
+                if (disk, face) in faces:
+                    centers = Layout(centers, size_x=size_x, size_y=size_y).cut(radius, by=by).centers
+                filtered[name][disk][face] = centers
+    return filtered
+
+
+def filter_configs(directory, output, radius=800, cache_dir=None, **kwargs):
+    '''
+    writes the filtered variant (see filter_layout) of every database in directory to the directory output as
+    '<name> filtered <radius>'. returns the file name -> filtered database
+    '''
+    os.makedirs(output, exist_ok=True)
+    suffix = ' filtered %g' % radius
+    databases = {}
+    for name, database in load_layouts(directory, selection=lambda name: 'filtered' not in name, cache_dir=cache_dir).items():
+        databases[name + suffix] = filter_layout(database, radius=radius, **kwargs)
+        with open(os.path.join(output, name + suffix), 'w') as f:
+            dump_layout(databases[name + suffix], f)
+    return databases
@@ -0,0 +1,194 @@
+import itertools
+import os
+import time
+
+import numpy as np
+
+from ETL import Dee, Sensor2, layerPositions
+from acceptance import Z_LAYERS, ETA_MIN, ETA_MAX, generate_events
+from sweep import load_database
+from layout import MODULE_X, MODULE_Y, FRONT, BACK, Layout, make_txt2, sensor_centers, read_face
+
+
+# face of every layer (disk1 front, disk1 back, disk2 front, disk2 back), the two disks use the same faces
+LAYER_FACES = ['front', 'back', 'front', 'back']
+
+# make_txt2 parameters of the module grid of database_new_config_1, i.e. of the face files FRONT and BACK in new_configs
+# (the top row of the front faces is at y = 1071.25, the one of the back faces at 1114.1). the face files leave out
+# some of the modules make_txt2 places, the layout of database_new_config_1 itself is baseline_modules
+DEFAULT_PARAMS = {
+    'front_x': -28.7,
+    'front_y': 1071.25,
+    'front_gap_x': 1.65,
+    'front_gap_y': 29.2,
+    'back_x': -28.7,
+    'back_y': 1114.1,
+    'back_gap_x': 1.65,
+    'back_gap_y': 29.2,
+}
+
+
+class LayoutEvaluator(object):
+    def __init__(self, n_events=int(1e5), seed=0, z=Z_LAYERS, z_track=3000., eta_range=(ETA_MIN, ETA_MAX), sensor=None, r_inner=315, r_outer=1185, r_cut=None, cut_layers=(3,), min_hits=1):
+        '''
+        Scores layouts made by make_txt2 against one fixed sample of n_events tracks.
+        The track positions on the layers are computed once, a candidate only costs building the spatial index of its
+        two faces and looking up the positions.
+        r_cut (e.g. 800) only keeps the sensors with the center inside that radius on the layers in cut_layers (by
+        default disk2 back), as the filtered 800 configurations (see layout.filter_layout), and the modules with at
+        least one of them.
+        The score is the fraction of tracks with at least min_hits hits.
+        '''
+        self.sensor = Sensor2(21.4, 21.6) if sensor is None else sensor
+        self.r_inner = r_inner
+        self.r_outer = r_outer
+        self.r_cut = r_cut
+        self.cut_layers = cut_layers
+        self.min_hits = min_hits
+        self.n_events = n_events
+
+        eta, phi = generate_events(n_events, seed, *eta_range)
+        self.x, self.y = layerPositions(z, eta, phi, z_track=z_track)
+
+    def getModules(self, params):
+        '''
+        module centers of every layer, for the make_txt2 parameters in params (see DEFAULT_PARAMS)
+        '''
+        params = dict(DEFAULT_PARAMS, **params)
+        faces = {}
+        for face in set(LAYER_FACES):
+            faces[face] = np.array(make_txt2(
+                (params[face+'_x'], params[face+'_y']),
+                mod_size_x=MODULE_X,
+                mod_size_y=MODULE_Y,
+                mod_gap_x=params[face+'_gap_x'],
+                mod_gap_y=params[face+'_gap_y'],
+                inner_radius_dee=self.r_inner,
+                outer_radius_dee=self.r_outer,
+            )).reshape(-1, 2)
+
+        modules = []
+        for i, face in enumerate(LAYER_FACES):
+            centers = faces[face]
+            if self.r_cut is not None and i in self.cut_layers:
+                kept = Layout(sensor_centers(centers)).within(self.r_cut).reshape(len(centers), -1)
+                centers = centers[kept.any(axis=1)]
+            modules.append(centers)
+        return modules
+
+    def getSensors(self, modules):
+        '''
+        sensor centers of every layer for the module centers of every layer, with the cut of r_cut
+        '''
+        sensors = []
+        for i, centers in enumerate(modules):
+            centers = sensor_centers(centers)
+            if self.r_cut is not None and i in self.cut_layers:
+                centers = Layout(centers).cut(self.r_cut, by='center').centers
+            sensors.append(centers)
+        return sensors
+
+    def evaluate(self, modules):
+        '''
+        number of hits of every track for the module centers of every layer
+        '''
+        return self.evaluateSensors(self.getSensors(modules))
+
+    def evaluateSensors(self, sensors):
+        '''
+        number of hits of every track for the sensor centers of every layer, e.g. of a layout database (see
+        sweep.load_database)
+        '''
+        nHits = np.zeros(self.n_events, dtype=np.int16)
+        dees = {}
+        for i, centers in enumerate(sensors):
+            # the two disks share the faces, so every face is only indexed once
+            centers = np.ascontiguousarray(centers, dtype=float)
+            key = (centers.shape, centers.tobytes())
+            if key not in dees:
+                dee = Dee(self.r_inner, self.r_outer)
+                dee.fromCenters(centers, self.sensor, materialize=False)
+                dees[key] = dee
+            nHits += dees[key].intersect_many(self.x[i], self.y[i])
+        return nHits
+
+    def getScore(self, nHits):
+        return float((nHits >= self.min_hits).sum()/max(self.n_events, 1))
+
+    def score(self, params):
+        '''
+        returns the score and the total number of modules of a candidate
+        '''
+        modules = self.getModules(params)
+        return self.getScore(self.evaluate(modules)), sum(len(m) for m in modules)
+
+
+def baseline_modules(directory='new_configs', suffix=''):
+    '''
+    module centers of every layer of the face files FRONT<suffix> and BACK<suffix> in directory, by default the layout
+    of database_new_config_1 (see layout.CONFIGS)
+    '''
+    front, back = [read_face(os.path.join(directory, name + suffix)) for name in (FRONT, BACK)]
+    return [front if face == 'front' else back for face in LAYER_FACES]
+
+
+def check_baseline(evaluator, path=os.path.join('new_yamls_configs', 'database_new_config_1'), directory='new_configs', suffix=''):
+    '''
+    checks that baseline_modules gives the same hits as the sensors of the database at path with the tracks of
+    evaluator (which needs the sensor the database was exported with). raises a ValueError if not, returns the score
+    '''
+    nHits = evaluator.evaluate(baseline_modules(directory, suffix))
+    expected = evaluator.evaluateSensors(load_database(path))
+    if not (nHits == expected).all():
+        raise ValueError("the baseline gives %g, %s gives %g" % (evaluator.getScore(nHits), path, evaluator.getScore(expected)))
+    return evaluator.getScore(nHits)
+
+
+def random_candidates(space, n_candidates, seed=0):
+    '''
+    space is name -> (low, high), the candidates are drawn uniformly
+    '''
+    rng = np.random.default_rng(seed)
+    names = sorted(space)
+    values = {name: rng.uniform(*space[name], size=n_candidates) for name in names}
+    return [{name: float(values[name][i]) for name in names} for i in range(n_candidates)]
+
+
+def grid_candidates(space):
+    '''
+    space is name -> list of values, the candidates are all combinations
+    '''
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def search(evaluator, space, n_candidates=1000, method='random', seed=0, max_modules=None, min_modules=None, verbose=False):
+    '''
+    Searches the make_txt2 parameters (see DEFAULT_PARAMS, the ones not in space keep their default) for the best
+    layout with LayoutEvaluator.
+    method='random' draws n_candidates from space = name -> (low, high), method='grid' tries all combinations of
+    space = name -> list of values.
+    Candidates with more than max_modules or less than min_modules modules (summed over the layers) are not evaluated.
+    returns the evaluated candidates as dicts (parameters, score, n_modules), best first
+    '''
+    if method == 'random':
+        candidates = random_candidates(space, n_candidates, seed=seed)
+    elif method == 'grid':
+        candidates = grid_candidates(space)
+    else:
+        raise ValueError("method has to be 'random' or 'grid', not %s" % method)
+
+    results = []
+    start = time.time()
+    for i, params in enumerate(candidates):
+        modules = evaluator.getModules(params)
+        n_modules = sum(len(m) for m in modules)
+        if (max_modules is not None and n_modules > max_modules) or (min_modules is not None and n_modules < min_modules):
+            continue
+        score = evaluator.getScore(evaluator.evaluate(modules))
+        results.append(dict(params, score=score, n_modules=n_modules))
+        if verbose and (i+1) % 100 == 0:
+            print("%d/%d candidates, %.1f s" % (i+1, len(candidates), time.time()-start))
+
+    results.sort(key=lambda r: (-r['score'], r['n_modules']))
+    return results
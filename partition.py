@@ -1,26 +1,4 @@
-import copy
-
-def getN(d, count, nMin=99, resMin=99, keys=[0,0,0], maxDepth=0, best_keys=[]):
-    maxDepth += 1
-    for x in d.keys():
-        keys[maxDepth-1] = x
-        if type(d[x]) == type(0):
-            if (d[x] < resMin) and (d[x]>=0):
-                nMin = count + x
-                resMin = d[x]
-                if maxDepth < len(keys):
-                    for i in range(maxDepth, len(keys)):
-                        keys[i] = 0
-                best_keys = copy.deepcopy(keys)
-            elif (d[x] <= resMin) and ((count + x) < nMin):
-                nMin = count + x
-                resMin = d[x]
-                if maxDepth < len(keys):
-                    for i in range(maxDepth, len(keys)):
-                        keys[i] = 0
-        else:
-            nMin, resMin, best_keys = getN(d[x], count+x, nMin=nMin, resMin=resMin, keys=keys, maxDepth=maxDepth, best_keys=best_keys)
-    return nMin, resMin, best_keys
+from functools import lru_cache
 
 
 def partition(length, flavors=[3,6,7]):
@@ -52,18 +30,37 @@ def partition(length, flavors=[3,6,7]):
 
     return counter
 
-def getPartition(length, flavors=[3,6,7]):
+@lru_cache(maxsize=None)
+def solve(length, flavors):
+    '''
+    dynamic programming version of the search through the partition tree.
+    flavors is a sorted tuple, the result is memoized across calls.
+    returns (residual, number of supermodules, multiplicities of the flavors from the largest to the smallest)
+    for the decomposition with the smallest residual, and the smallest number of supermodules for that residual.
+    for ties the one with the most large flavors wins, like the first leaf of the partition tree.
+    '''
+    flav = flavors[-1]
+    if len(flavors) == 1:
+        return length % flav, length//flav, (length//flav,)
 
-    c = partition(length, flavors)
-    res = getN(c, 0, nMin=99, resMin=99, keys=[0,0,0], maxDepth=0, best_keys=[])
+    best = None
+    for n in reversed(range(length//flav + 1)):
+        residual, count, keys = solve(length - n*flav, flavors[:-1])
+        if best is None or (residual, count + n) < best[:2]:
+            best = (residual, count + n, (n,) + keys)
+    return best
 
-    partition_list = []
 
-    for i, flav in enumerate(reversed(flavors)):
-        partition_list += [flav]*res[2][i]
-    
-    del c, res
+def getPartition(length, flavors=[3,6,7]):
+    '''
+    list of the supermodule sizes (largest first) that cover most of a row of length slots, any number of flavors.
+    '''
+    flavors = tuple(sorted(set(flavors)))
+    res = solve(length, flavors)
 
-    return partition_list
+    partition_list = []
 
+    for flav, n in zip(reversed(flavors), res[2]):
+        partition_list += [flav]*n
 
+    return partition_list
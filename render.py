@@ -0,0 +1,176 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+
+from ETL import colors
+
+
+# what draw_dee draws by default, from the bottom to the top
+LAYERS = ('supermodules', 'boards', 'sensors', 'active')
+
+# styles of the layers, as in the getPolygon methods. the face colors of supermodules, boards and sensors are their color
+STYLES = {
+    'supermodules': dict(edgecolor='black', linewidth=1.5, alpha=0.5),
+    'boards': dict(edgecolor='black', linewidth=0.5, alpha=0.5),
+    'modules': dict(facecolor='none', edgecolor='black', linewidth=0.5),
+    'sensors': dict(edgecolor='black', linewidth=0.3, alpha=0.5),
+    'active': dict(facecolor='gray', edgecolor='none', alpha=0.5),
+}
+
+# draw_dee(raster='auto') rasterizes the layers with more rectangles than this
+RASTER_THRESHOLD = 100000
+
+
+def rectangleVertices(x1, x2, y1, y2):
+    '''
+    (N, 4, 2) array of the corners of rectangles, in the order of the outlines ((x1, y2), (x2, y2), (x2, y1), (x1, y1))
+    '''
+    x1, x2, y1, y2 = [np.asarray(v, dtype=float).ravel() for v in (x1, x2, y1, y2)]
+    return np.stack([
+        np.stack([x1, y2], axis=1),
+        np.stack([x2, y2], axis=1),
+        np.stack([x2, y1], axis=1),
+        np.stack([x1, y1], axis=1),
+    ], axis=1)
+
+
+def rectangleCollection(x1, x2, y1, y2, **kwargs):
+    '''
+    one PolyCollection for all the rectangles, the keyword arguments are passed on (facecolors can be one color per rectangle)
+    '''
+    return PolyCollection(rectangleVertices(x1, x2, y1, y2), closed=True, **kwargs)
+
+
+def rasterize(x1, x2, y1, y2, extent, resolution=1.):
+    '''
+    number of rectangles covering the center of every cell of a grid with cell size resolution over
+    extent = (xmin, xmax, ymin, ymax).
+    every rectangle adds +1/-1 at its corners of a difference image, which is summed up along both axes,
+    so the cost does not depend on the size of the rectangles.
+    returns the image with the rows going up in y (for imshow with origin='lower')
+    '''
+    x1, x2, y1, y2 = [np.asarray(v, dtype=float).ravel() for v in (x1, x2, y1, y2)]
+    xmin, xmax, ymin, ymax = extent
+    n_x = int(np.ceil((xmax-xmin)/resolution))
+    n_y = int(np.ceil((ymax-ymin)/resolution))
+
+    # first and one past the last cell with the center inside the rectangle
+    ix1 = np.clip(np.ceil((x1-xmin)/resolution - 0.5), 0, n_x).astype(np.int64)
+    ix2 = np.clip(np.ceil((x2-xmin)/resolution - 0.5), 0, n_x).astype(np.int64)
+    iy1 = np.clip(np.ceil((y1-ymin)/resolution - 0.5), 0, n_y).astype(np.int64)
+    iy2 = np.clip(np.ceil((y2-ymin)/resolution - 0.5), 0, n_y).astype(np.int64)
+
+    diff = np.zeros((n_y+1)*(n_x+1), dtype=np.int64)
+    for iy, ix, step in [(iy1, ix1, 1), (iy1, ix2, -1), (iy2, ix1, -1), (iy2, ix2, 1)]:
+        diff += np.bincount(iy*(n_x+1) + ix, minlength=len(diff))*step
+    diff = diff.reshape(n_y+1, n_x+1)
+    return diff.cumsum(axis=0).cumsum(axis=1)[:n_y, :n_x]
+
+
+def _corners(parts):
+    corners = np.array([p.getCorners() for p in parts], dtype=float).reshape(-1, 4)
+    return corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+
+
+def getRectangles(dee, layer):
+    '''
+    corners x1, x2, y1, y2 and face colors (None if the layer has no colors) of one layer of a Dee:
+    supermodules (colored by flavor), boards (RB and PB), modules, sensors or active (see Dee.getActiveRectangles,
+    the pixels if the Dee has them).
+    supermodules, boards and modules need a populated Dee, sensors a Dee with Sensor objects.
+    '''
+    supermodules = getattr(dee, 'supermodules', [])
+    if layer == 'supermodules':
+        return _corners(supermodules) + ([colors.get(sm.n_modules, sm.color) for sm in supermodules],)
+    if layer == 'boards':
+        boards = [b for sm in supermodules for b in (sm.RB, sm.PB)]
+        return _corners(boards) + ([b.color for b in boards],)
+    if layer == 'modules':
+        return _corners([m for sm in supermodules for m in sm.modules]) + (None,)
+    if layer == 'sensors':
+        if supermodules:
+            sensors = [s for sm in supermodules for m in sm.modules for s in m.sensors]
+        else:
+            sensors = getattr(dee, 'sensors', [])
+        return _corners(sensors) + ([s.color for s in sensors],)
+    if layer == 'active':
+        return tuple(dee.getActiveRectangles()) + (None,)
+    raise ValueError("unknown layer %s, use one of %s" % (layer, ', '.join(STYLES)))
+
+
+def draw_dee(dee, ax=None, layers=LAYERS, raster='auto', resolution=0.5, circles=True, styles=None):
+    '''
+    Draws a Dee with one PolyCollection per layer (see getRectangles), instead of one patch per object.
+    Layers with more than RASTER_THRESHOLD rectangles (raster='auto'), or all layers (raster=True), are drawn as an
+    image with cells of resolution (in mm), which is much faster and smaller for dense pixel maps.
+    styles can override the STYLES of the layers, e.g. {'active': dict(facecolor='blue')}.
+    circles draws the inner and outer radius.
+    returns the axes
+    '''
+    if ax is None:
+        ax = plt.gca()
+    if styles is None:
+        styles = {}
+
+    for layer in layers:
+        x1, x2, y1, y2, facecolors = getRectangles(dee, layer)
+        if len(x1) == 0:
+            continue
+        style = dict(STYLES[layer], **styles.get(layer, {}))
+
+        if raster is True or (raster == 'auto' and len(x1) > RASTER_THRESHOLD):
+            draw_raster(x1, x2, y1, y2, ax=ax, resolution=resolution, color=style.get('facecolor', 'gray'),
+                        alpha=style.get('alpha', 1.))
+            continue
+
+        if facecolors is not None and 'facecolor' not in style:
+            style['facecolors'] = facecolors
+        ax.add_collection(rectangleCollection(x1, x2, y1, y2, **style))
+
+    if circles:
+        ax.add_patch(plt.Circle((0, 0), dee.r_inner, fill=None, edgecolor='r'))
+        ax.add_patch(plt.Circle((0, 0), dee.r_outer, fill=None, edgecolor='r'))
+
+    ax.autoscale_view()
+    ax.set_aspect('equal')
+    return ax
+
+
+def draw_raster(x1, x2, y1, y2, ax=None, resolution=0.5, extent=None, color='gray', alpha=1.):
+    '''
+    draws the cells covered by the rectangles (see rasterize) in one color
+    '''
+    from matplotlib.colors import ListedColormap
+
+    if ax is None:
+        ax = plt.gca()
+    if extent is None:
+        extent = (np.min(x1), np.max(x2), np.min(y1), np.max(y2))
+    image = rasterize(x1, x2, y1, y2, extent, resolution=resolution)
+    # the image covers whole cells
+    extent = (extent[0], extent[0] + image.shape[1]*resolution, extent[2], extent[2] + image.shape[0]*resolution)
+    covered = np.ma.masked_equal(np.minimum(image, 1), 0)
+    ax.imshow(covered, extent=extent, origin='lower', cmap=ListedColormap([color]), alpha=alpha,
+              interpolation='nearest', aspect='equal')
+    return ax
+
+
+def draw_modules(module_centers, sensor_centers=None, ax=None, module_x=43.1, module_y=56.5, sensor_x=21.4, sensor_y=21.6, circles=True):
+    '''
+    draws the outlines of modules and their sensors given by the centers (as in realistic_layout_export.ipynb)
+    '''
+    if ax is None:
+        ax = plt.gca()
+    x, y = np.asarray(module_centers, dtype=float).reshape(-1, 2).T
+    ax.add_collection(rectangleCollection(x-module_x/2, x+module_x/2, y-module_y/2, y+module_y/2,
+                                          facecolor='none', edgecolor='b', linewidth=0.5))
+    if sensor_centers is not None:
+        x, y = np.asarray(sensor_centers, dtype=float).reshape(-1, 2).T
+        ax.add_collection(rectangleCollection(x-sensor_x/2, x+sensor_x/2, y-sensor_y/2, y+sensor_y/2,
+                                              facecolor='blue', edgecolor='none', alpha=0.6))
+    if circles:
+        ax.add_patch(plt.Circle((0, 0), 315, fill=None, edgecolor='r'))
+        ax.add_patch(plt.Circle((0, 0), 1185, fill=None, edgecolor='r'))
+    ax.autoscale_view()
+    ax.set_aspect('equal')
+    return ax
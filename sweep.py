@@ -0,0 +1,289 @@
+import argparse
+import csv
+import importlib.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import instrument
+from ETL import Dee, Sensor, Sensor2
+from cache import ResultCache, layout_key
+from layout import load_layout, module_centers
+from acceptance import LAYERS, Z_LAYERS, ETA_MIN, ETA_MAX, CHUNK_SIZE, AcceptanceHistograms, stream_histograms
+
+
+# number of event shards of run_sweep. fixed, so that a seed gives the same results on every machine
+N_SHARDS = 16
+
+
+def load_database(path):
+    '''
+    returns the layer centers of a layout database (disk -> face -> centers) as (N, 2) arrays in the order of LAYERS.
+    the databases are loaded through the binary cache of layout.load_layout
+    '''
+    disks = list(load_layout(path).values())[0]
+    return [disks[disk][face] for disk, face in LAYERS]
+
+
+def load_configurations(directory, selection=None):
+    '''
+    all layout databases in a directory (e.g. new_yamls_configs), as name -> layer centers.
+    selection is an optional function of the file name, e.g. lambda name: 'filtered' in name
+    '''
+    configs = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.startswith('.') or (selection is not None and not selection(name)):
+            continue
+        configs[name] = load_database(path)
+    return configs
+
+
+def build_layers(centers, sensor, pixels=None, r_inner=315, r_outer=1185):
+    '''
+    the Dees of the layers, only with the corner arrays needed for the hit tests.
+    pixels is None or (m, n, gap) of the pixels of every sensor (see Dee.setPixels)
+    '''
+    layers = []
+    for c in centers:
+        dee = Dee(r_inner, r_outer)
+        dee.fromCenters(c, sensor, materialize=False)
+        if pixels is not None:
+            dee.setPixels(*pixels, sensor_type=type(sensor))
+        layers.append(dee)
+    return layers
+
+
+def shard_seeds(seed, n_shards):
+    '''
+    one independent seed per event shard, the same for every configuration
+    '''
+    return np.random.SeedSequence(seed).spawn(n_shards)
+
+
+def shard_sizes(n_events, n_shards):
+    return [n_events//n_shards + (1 if i < n_events % n_shards else 0) for i in range(n_shards)]
+
+
+# layers built by a worker process, so every configuration is only built once per worker
+_layers = {}
+
+
+def run_job(job):
+    '''
+    propagates one event shard through one configuration.
+    profile is None, or in a worker process whether the instrumentation measures the memory: then the job is recorded
+    and returned together with the result, to be merged in the main process.
+    '''
+    name, centers, sensor, pixels, n_events, seed, z, eta_range, bins, profile = job
+    if profile is not None:
+        with instrument.recording(memory=profile):
+            result = run_job(job[:-1] + (None,))
+        return result, instrument.getStats()
+    if name not in _layers:
+        _layers[name] = build_layers(centers, sensor, pixels=pixels)
+    return stream_histograms(_layers[name], n_events, seed, z=z, eta_range=eta_range, bins=bins)
+
+
+def run_sweep(configs, sensor=None, pixels=None, n_events=int(1e5), n_shards=N_SHARDS, seed=0, workers=None, z=Z_LAYERS, eta_range=None, bins=None, cache=None):
+    '''
+    Runs every configuration (name -> layer centers, see load_configurations) over the same event sample.
+    The sample is split into n_shards shards with their own seeds, and the (configuration x shard) jobs are distributed
+    over a pool of worker processes (workers=1 runs everything in this process).
+    sensor is a Sensor/Sensor2 or a dict name -> sensor, the default is the Sensor2(21.4, 21.6) of the new layouts.
+    pixels is (m, n, gap) to count only hits on the pixels of the sensors.
+    The per-shard histograms only hold integer counts and are merged in shard order, so the results only depend on the
+    seed and n_shards, not on the number of workers.
+    cache is a cache.ResultCache (or True for the default one): configurations that were already run with the same
+    centers, sensor, events and binning are read from it, only the others are computed (and stored).
+    returns name -> AcceptanceHistograms
+    '''
+    if sensor is None:
+        sensor = Sensor2(21.4, 21.6)
+    if eta_range is None:
+        eta_range = (ETA_MIN, ETA_MAX)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if cache is True:
+        cache = ResultCache()
+    sensors = {name: sensor[name] if isinstance(sensor, dict) else sensor for name in configs}
+
+    cached = {}
+    keys = {}
+    if cache is not None:
+        for name, centers in configs.items():
+            keys[name] = layout_key(centers, sensors[name], pixels=pixels, n_events=n_events, n_shards=n_shards, seed=seed, z=z,
+                                    eta_range=eta_range, bins=bins, chunk_size=CHUNK_SIZE)
+            result = cache.get(keys[name])
+            if result is not None:
+                cached[name] = result
+
+    seeds = shard_seeds(seed, n_shards)
+    sizes = shard_sizes(n_events, n_shards)
+    # the workers record their own instrumentation, see run_job
+    profile = instrument.MEMORY if instrument.ENABLED and workers != 1 else None
+    jobs = [
+        (name, centers, sensors[name], pixels, size, shard_seed, z, eta_range, bins, profile)
+        for name, centers in configs.items() if name not in cached
+        for size, shard_seed in zip(sizes, seeds)
+    ]
+
+    if not jobs:
+        results = []
+    elif workers == 1:
+        _layers.clear()
+        results = [run_job(job) for job in jobs]
+        _layers.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_job, jobs))
+        if profile is not None:
+            for result, stats in results:
+                instrument.merge(stats)
+            results = [result for result, stats in results]
+
+    merged = {}
+    for job, result in zip(jobs, results):
+        name = job[0]
+        if name not in merged:
+            merged[name] = AcceptanceHistograms(n_layers=len(z), bins=bins)
+        merged[name] += result
+
+    if cache is not None:
+        for name, histograms in merged.items():
+            cache.put(keys[name], histograms)
+
+    return {name: cached[name] if name in cached else merged[name] for name in configs}
+
+
+def efficiency_table(results, configs=None, module=(2, 2)):
+    '''
+    the results of run_sweep as two tables of columns (name -> list):
+    bins: efficiency, binomial error and Wilson interval (one sigma) per bin of every variable (eta, r, phi) of every
+    configuration,
+    summary: overall efficiency, fractions of the number of hits and number of sensors and modules per layer (from
+    configs). the modules of module = (m, n) sensors are found with layout.module_centers, for the filtered
+    configurations these are the modules with at least one sensor left.
+    '''
+    bins = {column: [] for column in ('config', 'variable', 'bin', 'low', 'high', 'tracks', 'hit', 'efficiency', 'error',
+                                      'wilson_low', 'wilson_high')}
+    summary = {}
+    for name, histograms in results.items():
+        for var in histograms.bins:
+            edges = histograms.edges[var]
+            hit, tracks = histograms.getCounts(var)
+            efficiency = histograms.getEfficiency(var)
+            error = histograms.getError(var)
+            low, high = histograms.getInterval(var)
+            for i in range(len(edges)-1):
+                bins['config'].append(name)
+                bins['variable'].append(var)
+                bins['bin'].append(i)
+                bins['low'].append(float(edges[i]))
+                bins['high'].append(float(edges[i+1]))
+                bins['tracks'].append(int(tracks[i]))
+                bins['hit'].append(int(hit[i]))
+                bins['efficiency'].append(float(efficiency[i]))
+                bins['error'].append(float(error[i]))
+                bins['wilson_low'].append(float(low[i]))
+                bins['wilson_high'].append(float(high[i]))
+
+        row = dict(config=name, tracks=int(histograms.nHits.sum()), efficiency=float(histograms.getEfficiency()),
+                   error=float(histograms.getError()))
+        for n, fraction in enumerate(histograms.getFractions()):
+            row['hits_%d' % n] = float(fraction)
+        if configs is not None:
+            n_sensors = [len(c) for c in configs[name]]
+            n_modules = [len(module_centers(c, *module)) for c in configs[name]]
+            for (disk, face), n in zip(LAYERS, n_sensors):
+                row['sensors_%s_%s' % (disk, face)] = n
+            row['sensors'] = sum(n_sensors)
+            for (disk, face), n in zip(LAYERS, n_modules):
+                row['modules_%s_%s' % (disk, face)] = n
+            row['modules'] = sum(n_modules)
+        for column, value in row.items():
+            summary.setdefault(column, []).append(value)
+
+    return bins, summary
+
+
+def parquet_engine():
+    '''
+    whether pandas can write parquet (pyarrow or fastparquet is installed)
+    '''
+    return any(importlib.util.find_spec(name) is not None for name in ('pyarrow', 'fastparquet'))
+
+
+def write_table(columns, path):
+    '''
+    writes a table of columns (name -> list) as csv, or parquet (with pandas) if path ends with .parquet
+    '''
+    if path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(columns).to_parquet(path, index=False)
+        return
+    names = list(columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*[columns[name] for name in names]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the geometric acceptance of all layout databases in a directory')
+    parser.add_argument('directory', help='directory with the layout databases, e.g. new_yamls_configs')
+    parser.add_argument('--select', default=None, help='only the databases with this in the file name')
+    parser.add_argument('--output', default='sweep', help='the tables are written to <output>_bins.<format> and <output>_summary.<format>')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--sensor', type=float, nargs=2, default=[21.4, 21.6], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--sensor-type', default='Sensor2', choices=['Sensor', 'Sensor2'])
+    parser.add_argument('--deadspace', type=float, nargs='+', default=None,
+                        help='deadspace of Sensor, or deadspace1 deadspace2 of Sensor2 (default: the ones of the classes)')
+    parser.add_argument('--module', type=int, nargs=2, default=[2, 2], metavar=('M', 'N'),
+                        help='sensors per module, for the module counts of the summary (modules with at least one sensor left)')
+    parser.add_argument('--pixels', type=float, nargs=3, default=None, metavar=('M', 'N', 'GAP'),
+                        help='only count hits on a grid of m x n pixels separated by gap')
+    parser.add_argument('--z', type=float, nargs='+', default=Z_LAYERS, help='z positions of the layers in m')
+    parser.add_argument('--eta', type=float, nargs=2, default=[ETA_MIN, ETA_MAX], metavar=('MIN', 'MAX'))
+    parser.add_argument('--events', type=float, default=1e6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=N_SHARDS,
+                        help='number of event shards. the results only depend on the seed and the number of shards, not on the number of workers')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--cache', action='store_true', help='use the result cache (see cache.py)')
+    args = parser.parse_args(argv)
+
+    if args.sensor_type == 'Sensor':
+        deadspace = {} if args.deadspace is None else dict(deadspace=args.deadspace[0])
+        sensor = Sensor(*args.sensor, **deadspace)
+    else:
+        deadspace = {} if args.deadspace is None else dict(zip(('deadspace1', 'deadspace2'), args.deadspace))
+        sensor = Sensor2(*args.sensor, **deadspace)
+    pixels = None if args.pixels is None else (int(args.pixels[0]), int(args.pixels[1]), args.pixels[2])
+
+    if args.format == 'parquet' and not parquet_engine():
+        parser.error("--format parquet needs pyarrow or fastparquet, install one of them or use --format csv")
+
+    configs = load_configurations(args.directory, selection=None if args.select is None else lambda name: args.select in name)
+    if not configs:
+        parser.error("no layout databases in %s" % args.directory)
+
+    results = run_sweep(configs, sensor=sensor, pixels=pixels, n_events=int(args.events), n_shards=args.shards,
+                        seed=args.seed, workers=args.workers, z=args.z, eta_range=tuple(args.eta), cache=True if args.cache else None)
+
+    bins, summary = efficiency_table(results, configs, module=tuple(args.module))
+    for table, columns in (('bins', bins), ('summary', summary)):
+        path = '%s_%s.%s' % (args.output, table, args.format)
+        write_table(columns, path)
+        print("wrote", path)
+    for name, eff in zip(summary['config'], summary['efficiency']):
+        print("%-40s %.5f" % (name, eff))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())